@@ -0,0 +1,322 @@
+import argparse
+import copy
+import os
+import random
+import tempfile
+import time
+
+import networkx as nx
+import numpy as np
+import torch
+
+from slad_dataloader import Node, build_tree_from_txt, get_k_hop_subgraph_of_target_node, nx_edge_index, \
+    parse_graph_file, parse_k_hop_graph_to_data, read_embedding_table
+from slad_mcts import ExactNeighborIndex, IVFNeighborIndex, select_prototypes_with_most_distance_each_other
+
+
+def write_synthetic_trace(file_path, span_num, name_num=50, seed=42):
+    """write a forum-style trace file whose spans reuse a small pool of names, so duplicate instances abound"""
+    rng = random.Random(seed)
+    names = [f"pub.synthetic.Service{i}" for i in range(name_num)]
+    span_names = ["root"]
+    lines = ["traceID=synthetic\n", "label=" + names[0] + "\n", "network[son<-parent]=\n"]
+    for i in range(1, span_num + 1):
+        parent = rng.randint(max(0, i - 20), i - 1)  # bounded depth, preorder parent
+        span_names.append(rng.choice(names))
+        weight = span_num - i  # children always carry smaller weights than their parents
+        lines.append(f"{span_names[i]}<-{span_names[parent]},{weight},span={i},cost={rng.randint(1, 99)}ms,"
+                     f"event=get user id:* information,exception=null\n")
+    with open(file_path, "w") as file:
+        file.writelines(lines)
+
+
+def build_tree_from_txt_linear_scan(file_path, gid):
+    """reference parser resolving parents by scanning every node key, i.e. the pre-index behaviour"""
+    root = Node("", "root", gid)
+    nodes = {"root:0": (root, -1, '', 0)}
+    edge_info_tuples = []
+    dup_node_count = {}
+    anomalous_nodes = []
+    with open(file_path, "r") as file:
+        lines = file.readlines()
+        start_filter = lines.index("network[son<-parent]=\n")
+        for line in lines[:start_filter]:
+            if line.startswith("traceID="):
+                trace_id = line.strip().split("=")[1]
+                root.trace_id = trace_id
+            if line.startswith("label="):
+                anomalous_nodes.append(line.strip().split("=")[1])
+        for line in lines[start_filter + 1:]:
+            line = line.strip()
+            if line:
+                parts = line.split(",")
+                edge = parts[0].split("<-")
+                weight = int(parts[1])
+                target_node_name = edge[0].strip()
+                source_node_name = edge[1].strip()
+                target_node_props = ",".join(parts[2:])
+                dup_count = dup_node_count.get(target_node_name, 0)
+                dup_node_count[target_node_name] = dup_count + 1
+                edge_info_tuples.append((target_node_name + ":" + str(dup_count), source_node_name, weight))
+                node_label = 1 if target_node_name in anomalous_nodes else 0
+                nodes[target_node_name + ":" + str(dup_count)] = (
+                    Node(trace_id, target_node_name + ":" + str(dup_count), gid), weight, target_node_props,
+                    node_label)
+    for target_node_name, source_node_name, weight in edge_info_tuples:
+        target_node, t_weight, t_props, t_node_label = nodes[target_node_name]
+        src_nodes_candidate = [nodes[k] for k in nodes.keys() if k.split(":")[0] == source_node_name]
+        src_nodes_candidate.sort(key=lambda t: t[1])
+        for src_node, src_weight, _, _ in src_nodes_candidate:
+            if weight < src_weight or source_node_name == "root":
+                src_node.children.append((target_node, weight, t_props, t_node_label))
+                break
+    return root
+
+
+def tree_signature(root):
+    """flatten a tree into (parent, child, weight, props, label) tuples in traversal order"""
+    signature = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for child, weight, props, label in node.children:
+            signature.append((node.name, child.name, weight, props, label))
+            stack.append(child)
+    return signature
+
+
+def bench_build_tree(sizes, legacy_max_size):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for span_num in sizes:
+            file_path = os.path.join(tmp_dir, f"{span_num}-trace.txt")
+            write_synthetic_trace(file_path, span_num)
+            start_time = time.time()
+            root = build_tree_from_txt(file_path, "0")
+            index_time = time.time() - start_time
+            line = f"spans={span_num}, indexed parse: {index_time:.3f}s"
+            if span_num <= legacy_max_size:
+                start_time = time.time()
+                legacy_root = build_tree_from_txt_linear_scan(file_path, "0")
+                legacy_time = time.time() - start_time
+                same = tree_signature(root) == tree_signature(legacy_root)
+                line += f", linear scan parse: {legacy_time:.3f}s, speedup: {legacy_time / index_time:.1f}x, " \
+                        f"identical tree: {same}"
+            print(line)
+
+
+def synthetic_graphs(num_graphs, num_nodes, feature_dim=484, seed=42):
+    """halo-like graphs: a random tree below "root" plus a few cross edges, every node with a feature list"""
+    rng = random.Random(seed)
+    graphs = []
+    for _ in range(num_graphs):
+        G = nx.Graph()
+        names = ["root"] + [f"service{i}" for i in range(1, num_nodes)]
+        for i in range(1, num_nodes):
+            G.add_edge(names[i], names[rng.randint(0, i - 1)])
+        for _ in range(num_nodes // 10):
+            u, v = rng.sample(names, 2)
+            G.add_edge(u, v)
+        for node in G.nodes():
+            G.nodes[node]["feature"] = [float(rng.random() < 0.01) for _ in range(feature_dim)]
+        graphs.append(G)
+    return graphs
+
+
+def load_halo_graphs(max_graphs):
+    """the first max_graphs halo traces of ./halo_dataset, or None if the dataset is not in place"""
+    if not os.path.isdir("./halo_dataset") or not os.path.isdir("./halo_data"):
+        return None
+    tables = [read_embedding_table("./halo_data/" + name, 161) for name in
+              ["events_compress_one_hot.txt", "file_name_one_hot.txt", "exception_list.txt"]]
+    file_names = sorted(os.listdir("./halo_dataset"))[:max_graphs]
+    return [parse_graph_file("halo", os.path.join("./halo_dataset", file_name), *tables)[1] for file_name in
+            file_names]
+
+
+def edge_index_by_list_index(graph):
+    """reference conversion looking every edge end up with list(graph.nodes).index, i.e. O(V * E)"""
+    edges = [[list(graph.nodes).index(u), list(graph.nodes).index(v)] for u, v in graph.edges]
+    return torch.tensor(np.transpose(edges).tolist()).long()
+
+
+def bench_k_hop_edge_index(k, max_graphs, synthetic_nodes):
+    graphs = load_halo_graphs(max_graphs)
+    if graphs is None:
+        print("./halo_dataset not found, using synthetic halo-like graphs")
+        graphs = synthetic_graphs(max_graphs, synthetic_nodes)
+    k_hop_subgraphs = []
+    for graph in graphs:
+        for node in graph.nodes():
+            neighbors = nx.single_source_shortest_path_length(graph, node, cutoff=k).keys()
+            k_hop_subgraphs.append(graph.subgraph(neighbors))
+    print(f"graphs: {len(graphs)}, k-hop subgraphs: {len(k_hop_subgraphs)}, "
+          f"avg nodes: {np.mean([g.number_of_nodes() for g in k_hop_subgraphs]):.1f}, "
+          f"avg edges: {np.mean([g.number_of_edges() for g in k_hop_subgraphs]):.1f}")
+
+    start_time = time.time()
+    legacy_edge_indices = [edge_index_by_list_index(g) for g in k_hop_subgraphs]
+    legacy_time = time.time() - start_time
+    start_time = time.time()
+    edge_indices = [nx_edge_index(g, {node: i for i, node in enumerate(g.nodes())}) for g in k_hop_subgraphs]
+    index_time = time.time() - start_time
+    same = all(torch.equal(a, b) for a, b in zip(legacy_edge_indices, edge_indices) if a.numel())
+    print(f"edge_index by list.index: {legacy_time:.3f}s, by node index map: {index_time:.3f}s, "
+          f"speedup: {legacy_time / index_time:.1f}x, identical edge_index: {same}")
+
+    start_time = time.time()
+    for g in k_hop_subgraphs:
+        torch.tensor([g.nodes[node]["feature"] for node in g.nodes()], dtype=torch.float)
+    feature_time = time.time() - start_time
+    print(f"whole conversion incl. node features: {legacy_time + feature_time:.3f}s -> "
+          f"{index_time + feature_time:.3f}s")
+
+
+def k_hop_subgraphs_by_bfs(graphs, k):
+    """reference extractor: deep copy, breadth-first search from every node, then a subgraph view and Data per node"""
+    k_hop_subgraphs = []
+    for graph in graphs:
+        graph_copy = copy.deepcopy(graph)
+        for node in graph_copy.nodes():
+            if node != "root":
+                neighbors = nx.single_source_shortest_path_length(graph_copy, node, cutoff=k).keys()
+                subgraph = graph.subgraph(neighbors)
+                k_hop_subgraphs.append((subgraph, parse_k_hop_graph_to_data(subgraph, 0, node)))
+    return k_hop_subgraphs
+
+
+def bench_k_hop_extraction(k, max_graphs, synthetic_nodes):
+    graphs = load_halo_graphs(max_graphs)
+    if graphs is None:
+        print("./halo_dataset not found, using synthetic halo-like graphs")
+        graphs = synthetic_graphs(max_graphs, synthetic_nodes)
+        for graph in graphs:
+            for node in graph.nodes():
+                graph.nodes[node]["label"] = 0
+    start_time = time.time()
+    legacy_k_hop_subgraphs = k_hop_subgraphs_by_bfs(graphs, k)
+    legacy_time = time.time() - start_time
+    start_time = time.time()
+    k_hop_subgraphs = get_k_hop_subgraph_of_target_node("halo", graphs, k, 0)
+    batched_time = time.time() - start_time
+    same = [set(subgraph.node_list) for _, _, _, subgraph, _ in k_hop_subgraphs] == [
+        set(subgraph.nodes()) for subgraph, _ in legacy_k_hop_subgraphs]
+    print(f"graphs: {len(graphs)}, k-hop subgraphs: {len(k_hop_subgraphs)}, per-node bfs: {legacy_time:.3f}s, "
+          f"batched: {batched_time:.3f}s, speedup: {legacy_time / batched_time:.1f}x, identical node sets: {same}")
+
+
+def clustered_embeddings(num_rows, dim=64, num_clusters=50, seed=42):
+    """gaussian blobs standing in for trained node embeddings, which gather around a few behaviours"""
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(num_clusters, dim, generator=generator) * 4
+    rows = torch.randint(num_clusters, (num_rows,), generator=generator)
+    return centers[rows] + torch.randn(num_rows, dim, generator=generator)
+
+
+def bench_knn_index(sizes, knn_k, num_queries, n_probes):
+    for num_rows in sizes:
+        embeddings = clustered_embeddings(num_rows)
+        queries = clustered_embeddings(num_queries, seed=7)
+        start_time = time.time()
+        distances = torch.norm(embeddings.unsqueeze(0) - queries.unsqueeze(1), dim=2) ** 2  # full scan, per query
+        truth = torch.topk(distances, k=knn_k, dim=1, largest=False).indices
+        scan_time = time.time() - start_time
+        start_time = time.time()
+        exact = ExactNeighborIndex(embeddings, block_size=16384).search(queries, knn_k)[1]
+        exact_time = time.time() - start_time
+        same = all(set(a) == set(b) for a, b in zip(truth.tolist(), exact.tolist()))
+        print(f"rows={num_rows}, full scan: {scan_time:.3f}s, exact blocked: {exact_time:.3f}s, "
+              f"identical neighbours: {same}")
+        start_time = time.time()
+        index = IVFNeighborIndex(embeddings)
+        print(f"  ivf build ({len(index.list_ptr) - 1} lists): {time.time() - start_time:.3f}s")
+        for n_probe in n_probes:
+            index.n_probe = min(n_probe, len(index.list_ptr) - 1)
+            start_time = time.time()
+            approx = index.search(queries, knn_k)[1]
+            ivf_time = time.time() - start_time
+            recall = np.mean([len(set(a) & set(b)) / knn_k for a, b in zip(truth.tolist(), approx.tolist())])
+            print(f"  ivf n_probe={n_probe}: {ivf_time:.3f}s, recall@{knn_k}: {recall:.3f}, "
+                  f"speedup over exact blocked: {exact_time / ivf_time:.1f}x")
+
+
+def select_prototypes_by_threshold_decay(bound, num_prototype, all_cand_prototype_list):
+    """reference prototype selection: greedy passes from scratch, shrinking the threshold by 1% after each failed one"""
+    if bound > len(all_cand_prototype_list):
+        bound = len(all_cand_prototype_list)
+    top_bound_prots = all_cand_prototype_list[:bound]
+    tensor_matrix = torch.stack(top_bound_prots)
+    distances = torch.cdist(tensor_matrix, tensor_matrix, compute_mode="donot_use_mm_for_euclid_dist")
+    dis_threshold = torch.max(distances).item()
+    candidates = []
+    need_loop = True
+    while need_loop:
+        for i in range(bound):
+            if not candidates:
+                candidates.append((top_bound_prots[i], i))
+            else:
+                ok = True
+                for cand, idx in candidates:
+                    if distances[i][idx].item() < dis_threshold:
+                        ok = False
+                        break
+                if ok:
+                    candidates.append((top_bound_prots[i], i))
+            if i == bound - 1 and len(candidates) != num_prototype:
+                dis_threshold = dis_threshold * 0.99
+                candidates.clear()
+            if len(candidates) == num_prototype:
+                need_loop = False
+                break
+    return torch.stack([candidate for candidate, _ in candidates])
+
+
+def min_pairwise_distance(prototypes):
+    distances = torch.cdist(prototypes, prototypes, compute_mode="donot_use_mm_for_euclid_dist")
+    return distances.fill_diagonal_(float("inf")).min().item()
+
+
+def bench_prototype_selection(sizes, legacy_max_size, num_prototype):
+    for bound in sizes:
+        candidates = list(clustered_embeddings(bound, dim=16))
+        start_time = time.time()
+        prototypes = select_prototypes_with_most_distance_each_other(bound, num_prototype, candidates)
+        search_time = time.time() - start_time
+        print(f"bound={bound}, binary search: {search_time:.3f}s, "
+              f"min distance: {min_pairwise_distance(prototypes):.3f}")
+        if bound <= legacy_max_size:
+            start_time = time.time()
+            legacy_prototypes = select_prototypes_by_threshold_decay(bound, num_prototype, candidates)
+            legacy_time = time.time() - start_time
+            print(f"  threshold decay: {legacy_time:.3f}s, min distance: {min_pairwise_distance(legacy_prototypes):.3f}, "
+                  f"speedup: {legacy_time / search_time:.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Micro benchmarks for SLAD preprocessing and search.')
+    parser.add_argument('--bench', type=str, default='build_tree', help='benchmark name: build_tree/k_hop_edge_index/k_hop_extraction/knn_index/prototype_selection')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='synthetic problem sizes')
+    parser.add_argument('--legacy_max_size', type=int, default=10000,
+                        help='largest size on which the reference implementation is also timed')
+    parser.add_argument('--k', type=int, default=6, help='hop number of k-hop subgraphs')
+    parser.add_argument('--max_graphs', type=int, default=200, help='number of halo (or synthetic) graphs')
+    parser.add_argument('--synthetic_nodes', type=int, default=60, help='node number of synthetic graphs')
+    parser.add_argument('--knn_k', type=int, default=200, help='neighbour number of knn rewards')
+    parser.add_argument('--num_queries', type=int, default=200, help='number of knn queries')
+    parser.add_argument('--n_probes', type=int, nargs='+', default=[1, 4, 8, 16, 32],
+                        help='inverted lists scanned per ivf query')
+    parser.add_argument('--num_prototype', type=int, default=10, help='prototypes selected per class')
+    args = parser.parse_args()
+
+    if args.bench == 'build_tree':
+        bench_build_tree(args.sizes, args.legacy_max_size)
+    elif args.bench == 'k_hop_edge_index':
+        bench_k_hop_edge_index(args.k, args.max_graphs, args.synthetic_nodes)
+    elif args.bench == 'k_hop_extraction':
+        bench_k_hop_extraction(args.k, args.max_graphs, args.synthetic_nodes)
+    elif args.bench == 'knn_index':
+        bench_knn_index(args.sizes, args.knn_k, args.num_queries, args.n_probes)
+    elif args.bench == 'prototype_selection':
+        bench_prototype_selection(args.sizes, args.legacy_max_size, args.num_prototype)
+    else:
+        raise ValueError("not supportive benchmark name.")
@@ -1,5 +1,8 @@
-import copy
+import bisect
+import concurrent.futures
+import hashlib
 import os
+import pickle
 import random
 
 import networkx as nx
@@ -65,69 +68,104 @@ def build_tree_from_txt(file_path, gid):
                 nodes[target_node_name + ":" + str(dup_count)] = (
                     Node(trace_id, target_node_name + ":" + str(dup_count), gid), weight, target_node_props,
                     node_label)  # 相同节点名字当作不同节点
+    """index duplicate instances by node name, sorted by weight, so that parent lookup is a bisect"""
+    name_index = {}  # key = node name, value = [instances sorted by weight, their weights]
+    for k, node_info in nodes.items():
+        k1 = k.split(":")[0]
+        if k1 in name_index:
+            name_index[k1][0].append(node_info)
+        else:
+            name_index[k1] = [[node_info], None]
+    for instances in name_index.values():
+        instances[0].sort(key=lambda t: t[1])  # stable, keeps file order for equal weights
+        instances[1] = [t[1] for t in instances[0]]
+
     for target_node_name, source_node_name, weight in edge_info_tuples:
         target_node, t_weight, t_props, t_node_label = nodes[target_node_name]
         # print(target_node, ",", t_weight, ",", t_props, ",", t_node_label)
-        src_nodes_candidate = []
-        for k in nodes.keys():
-            k1 = k.split(":")[0]
-            if k1 == source_node_name:
-                src_nodes_candidate.append(nodes[k])
-        src_nodes_candidate.sort(key=lambda t: t[1])
-        for src_node, src_weight, _, _ in src_nodes_candidate:
-            if weight < src_weight or source_node_name == "root":
-                src_node.children.append((target_node, weight, t_props, t_node_label))
-                break
+        if source_node_name not in name_index:
+            continue
+        src_nodes_candidate, src_weights = name_index[source_node_name]
+        if source_node_name == "root":
+            pos = 0
+        else:
+            pos = bisect.bisect_right(src_weights, weight)  # first instance with weight < src_weight
+        if pos < len(src_nodes_candidate):
+            src_node = src_nodes_candidate[pos][0]
+            src_node.children.append((target_node, weight, t_props, t_node_label))
 
     return root
 
 
-def read_event_one_hot(event_onehot_path, one_hot_length):
-    event_name_map = {}
-    with open(event_onehot_path, "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            line_old = line.split(" ->", 1)[0].replace("\n", "")
-            line_new = line.split(" ->", 1)[1].replace("\n", "").replace("[", "").replace("]", "").replace(" ", "")
-            ori_feat = [float(x) for x in line_new.split(",") if x]
-            event_one_hot = ori_feat + [float(0) for i in range(one_hot_length - len(ori_feat))]
-            if line_old in event_name_map:
-                continue
-            else:
-                event_name_map[line_old] = event_one_hot
-    return event_name_map
-
-
-def read_file_one_hot(file_embedding_path, one_hot_length):
-    file_name_map = {}
-    with open(file_embedding_path, "r") as file:
-        lines = file.readlines()
-        for line in lines:
-            line_old = line.split(" ->", 1)[0].replace("\n", "")
-            line_new = line.split(" ->", 1)[1].replace("\n", "").replace("[", "").replace("]", "").replace(" ", "")
-            ori_feat = [float(x) for x in line_new.split(",") if x]
-            file_one_hot = ori_feat + [float(0) for i in range(one_hot_length - len(ori_feat))]
-            if line_old in file_name_map:
-                continue
-            else:
-                file_name_map[line_old] = file_one_hot
-    return file_name_map
-
-
-def read_exception_one_hot(exception_embedding_path, one_hot_length):
-    excep_name_map = {}
-    with open(exception_embedding_path, "r") as file:
-        lines = file.readlines()
-        for line in lines:
-            line_old = line.split(" ->", 1)[0].replace("\n", "")
-            line_new = line.split(" ->", 1)[1].replace("\n", "").replace("[", "").replace("]", "").replace(" ", "")
-            ori_feat = [float(x) for x in line_new.split(",") if x]
-            file_one_hot = ori_feat + [float(0) for i in range(one_hot_length - len(ori_feat))]
-            if line_old in excep_name_map:
+class EmbeddingTable:
+    """one-hot embeddings stored as rows of a contiguous float32 matrix, with a name -> row index"""
+
+    def __init__(self, names, matrix):
+        self.names = names
+        self.index = {name: row for row, name in enumerate(names)}
+        self.matrix = matrix
+        self._padded_tensor = None  # matrix plus a trailing zero row, built on first gather
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return self.matrix[self.index[name]].tolist()
+
+    def __getstate__(self):
+        return {"names": self.names, "index": self.index, "matrix": self.matrix, "_padded_tensor": None}
+
+    def gather(self, rows):
+        """rows of the table as one tensor, row -1 gives a zero vector"""
+        if self._padded_tensor is None:
+            self._padded_tensor = torch.from_numpy(
+                np.concatenate([self.matrix, np.zeros((1, self.dim), dtype=np.float32)]))
+        return self._padded_tensor[torch.as_tensor(rows, dtype=torch.long)]
+
+
+def read_embedding_table(embedding_path, one_hot_length):
+    """
+    read lines like "name -> [1, 0, ...]" into an EmbeddingTable, zero padding vectors to one_hot_length.
+    The first line of a repeated name wins. The parsed matrix is cached next to the file as a .npy sidecar.
+    """
+    names = []
+    seen_names = set()
+    vector_texts = []
+    with open(embedding_path, "r") as file:
+        for line in file:
+            name, vector_text = line.split(" ->", 1)
+            name = name.replace("\n", "")
+            if name in seen_names:
                 continue
-            else:
-                excep_name_map[line_old] = file_one_hot
-    return excep_name_map
+            seen_names.add(name)
+            names.append(name)
+            vector_texts.append(vector_text)
+
+    sidecar_path = embedding_path + ".npy"
+    if os.path.exists(sidecar_path) and os.path.getmtime(sidecar_path) >= os.path.getmtime(embedding_path):
+        matrix = np.load(sidecar_path)
+        if matrix.shape == (len(names), one_hot_length) and matrix.dtype == np.float32:
+            return EmbeddingTable(names, matrix)
+
+    matrix = np.zeros((len(names), one_hot_length), dtype=np.float32)
+    for row, vector_text in enumerate(vector_texts):
+        values = vector_text.replace("\n", "").replace("[", "").replace("]", "").replace(" ", "")
+        values = [float(x) for x in values.split(",") if x]
+        if len(values) > one_hot_length:
+            raise ValueError(f"embedding of {names[row]} is longer than one hot length {one_hot_length}.")
+        matrix[row, :len(values)] = values
+    try:
+        np.save(sidecar_path, matrix)
+    except OSError:
+        pass  # read-only data directory, parse again next time
+    return EmbeddingTable(names, matrix)
 
 
 def read_file_id_map(path):
@@ -218,26 +256,24 @@ def draw_graph(G):
     plt.show()
 
 
-def print_mct(mct):
+def print_mct(tree):
+    """draw a MCTSTree, each node labelled with its W, C, R and the positions of its coalition nodes"""
 
     G = nx.DiGraph()
-    node_id_dict = {n: idx for idx, n in enumerate(mct.coalition)}
-    print(mct.coalition)
-    print(str(sorted([node_id_dict[x] for x in mct.coalition])))
-    G.add_node(str(sorted([node_id_dict[x] for x in mct.coalition])))
-    G.nodes[str(sorted([node_id_dict[x] for x in mct.coalition]))]["W"] = mct.W
-    G.nodes[str(sorted([node_id_dict[x] for x in mct.coalition]))]["C"] = mct.C
-    G.nodes[str(sorted([node_id_dict[x] for x in mct.coalition]))]["R"] = mct.R
-
-
-    def traverse(node):
-        for child in node.children:
-            G.add_edge(str(sorted([node_id_dict[x] for x in node.coalition])),
-                       str(sorted([node_id_dict[x] for x in child.coalition])))
-            G.nodes[str(sorted([node_id_dict[x] for x in child.coalition]))]["W"] = child.W
-            G.nodes[str(sorted([node_id_dict[x] for x in child.coalition]))]["C"] = child.C
-            G.nodes[str(sorted([node_id_dict[x] for x in child.coalition]))]["R"] = child.R
-            traverse(child)
+
+    def node_key(node_id):
+        return str([tree.node_pos[x] for x in tree.coalition_nodes(node_id)])
+
+    print(tree.coalition_nodes(0))
+    print(node_key(0))
+    for node_id in range(len(tree)):
+        G.add_node(node_key(node_id))
+        G.nodes[node_key(node_id)]["W"] = tree.W[node_id]
+        G.nodes[node_key(node_id)]["C"] = tree.C[node_id]
+        G.nodes[node_key(node_id)]["R"] = tree.R[node_id]
+    for node_id in range(len(tree)):
+        for child_id in tree.children[node_id]:
+            G.add_edge(node_key(node_id), node_key(child_id))
 
     def draw_graph(G):
 
@@ -257,39 +293,49 @@ def print_mct(mct):
 
         plt.show()
 
-    traverse(mct)
     draw_graph(G)
 
 
-def construct_tree_to_nx_with_feature(tree, event_map, file_name_map, exception_map):
-
+def construct_tree_to_nx_with_feature(tree, event_map, file_name_map, exception_map, compact_feature=False):
+    """
+    compact_feature keeps per-graph index arrays into the embedding tables in G.graph["feature_index"]
+    instead of a "feature" list on every node, see gather_node_features
+    """
     G = nx.Graph()
     feature_dim = []
+    feature_occurrences = []  # (node name, event row, file name row, exception row, cost), compact mode only
 
-    call_chain_paths = []
-    current_call_chain = []
+    leaf_count = [0]  # root-to-leaf call paths are numbered by their leaf in traversal order
     weight_list = []
 
 
     def traverse(node, feature_dim):
-        current_call_chain.append(node.name)
+        """returns the call path bitmask of node: bit i is set if node lies on the call path to leaf i"""
+        call_path_mask = 0
         if len(node.children) == 0:  # leaf node
-            call_chain_paths.append(copy.deepcopy(current_call_chain))
+            call_path_mask = 1 << leaf_count[0]
+            leaf_count[0] += 1
         for child, weight, props, label in node.children:
             G.add_edge(child.name, node.name)
             _, cost, event, exception = props.split(",")  # using "," to split attributes of properties
             file_name_key = child.name.split(":")[0]
-            if file_name_key not in file_name_map.keys():
-
-                file_name_embedding = [float(0)] * len(list(file_name_map.values())[0])
+            if compact_feature:
+                feature_occurrences.append((child.name, event_map.index[event.replace("event=", "", 1)],
+                                            file_name_map.index.get(file_name_key, -1),
+                                            exception_map.index[exception.replace("exception=", "", 1)],
+                                            float(cost.split("=")[1].split("m")[0])))
             else:
-                file_name_embedding = list(file_name_map[file_name_key])
-            G.nodes[child.name]["feature"] = event_map[event.replace("event=", "", 1)] + file_name_embedding + \
-                                             exception_map[
-                                                 exception.replace("exception=", "", 1)] + [
-                                                 float(cost.split("=")[1].split("m")[0])]
-            if not feature_dim:
-                feature_dim.append(len(G.nodes[child.name]["feature"]))
+                if file_name_key not in file_name_map:
+
+                    file_name_embedding = [float(0)] * file_name_map.dim
+                else:
+                    file_name_embedding = file_name_map[file_name_key]
+                G.nodes[child.name]["feature"] = event_map[event.replace("event=", "", 1)] + file_name_embedding + \
+                                                 exception_map[
+                                                     exception.replace("exception=", "", 1)] + [
+                                                     float(cost.split("=")[1].split("m")[0])]
+                if not feature_dim:
+                    feature_dim.append(len(G.nodes[child.name]["feature"]))
             G.nodes[child.name]["event"] = event.replace("event=", "", 1)
             G.nodes[child.name]["label"] = label
             G.nodes[child.name]["weight"] = weight
@@ -303,20 +349,18 @@ def construct_tree_to_nx_with_feature(tree, event_map, file_name_map, exception_
                 G.nodes[child.name]["exception"] = True
             else:
                 G.nodes[child.name]["exception"] = False
-            traverse(child, feature_dim)
-            current_call_chain.pop()  # pop last item of current call chain
+            call_path_mask |= traverse(child, feature_dim)
+        if node.name in G:
+            G.nodes[node.name]["call_paths"] = call_path_mask  # union of the call paths of its subtree
+        return call_path_mask
 
     traverse(tree, feature_dim)
-    """add each node's call chain path info"""
-    for node in G.nodes():
-        node_call_paths = []
-        for i, path in enumerate(call_chain_paths):
-            if node in path:
-                node_call_paths.append(i)
-        G.nodes[node]["call_paths"] = node_call_paths
     """add root node attributes"""
     G.nodes["root"]["event"] = ""
-    G.nodes["root"]["feature"] = [float(0)] * feature_dim[0]
+    if compact_feature:
+        set_feature_index(G, feature_occurrences)
+    else:
+        G.nodes["root"]["feature"] = [float(0)] * feature_dim[0]
     G.nodes["root"]["label"] = 0
     G.nodes["root"]["weight"] = max(weight_list) + 1
     G.nodes["root"]["cost"] = 0.0
@@ -327,7 +371,8 @@ def construct_tree_to_nx_with_feature(tree, event_map, file_name_map, exception_
     return G
 
 
-def construct_graph_to_nx_with_feature(file_path, event_map, file_name_map, exception_map):
+def read_graph_trace(file_path):
+    """edges of a halo-style trace file as [[target, source], cost, event, exception, label]"""
     anomalous_nodes = []  # anomalous nodes
     edges_with_props = []
     with open(file_path, "r") as file:
@@ -348,10 +393,15 @@ def construct_graph_to_nx_with_feature(file_path, event_map, file_name_map, exce
                 edge_info = [edge, parts[3], parts[4], parts[5],
                              1 if edge[0] in anomalous_nodes else 0]  # edge, cost, event, exception
                 edges_with_props.append(edge_info)
+    return edges_with_props
+
 
+def construct_graph_to_nx_with_feature(file_path, event_map, file_name_map, exception_map, compact_feature=False):
+    edges_with_props = read_graph_trace(file_path)
 
     G = nx.Graph()
     feature_dim = []
+    feature_occurrences = []  # features of repeated targets are summed, compact mode only
 
     for edge_info in edges_with_props:
         target, source = edge_info[0]
@@ -362,12 +412,18 @@ def construct_graph_to_nx_with_feature(file_path, event_map, file_name_map, exce
 
         if not G.has_edge(target, source):
             G.add_edge(target, source)
-        target_feature = event_map[event.replace("event=", "", 1)] + list(file_name_map[target]) + \
-                         exception_map[
-                             exception.replace("exception=", "", 1)] + [
-                             float(cost.split("=")[1].split("m")[0])]
-        if not feature_dim:
-            feature_dim.append(len(target_feature))
+        if compact_feature:
+            feature_occurrences.append((target, event_map.index[event.replace("event=", "", 1)],
+                                        file_name_map.index[target],
+                                        exception_map.index[exception.replace("exception=", "", 1)],
+                                        float(cost.split("=")[1].split("m")[0])))
+        else:
+            target_feature = event_map[event.replace("event=", "", 1)] + file_name_map[target] + \
+                             exception_map[
+                                 exception.replace("exception=", "", 1)] + [
+                                 float(cost.split("=")[1].split("m")[0])]
+            if not feature_dim:
+                feature_dim.append(len(target_feature))
         G.nodes[target]["label"] = label
         G.nodes[target]["name"] = target
         if G.nodes[target].get('exception', None) is None:
@@ -379,19 +435,23 @@ def construct_graph_to_nx_with_feature(file_path, event_map, file_name_map, exce
             if exception.replace("exception=", "", 1) != "null":
                 G.nodes[target]["exception"] = True
 
-        feature_value = G.nodes[target].get('feature', None)
-        if feature_value is not None:
-            feature_value = [x + y for x, y in zip(target_feature, feature_value)]
-            G.nodes[target]["feature"] = feature_value
-        else:
-            G.nodes[target]["feature"] = target_feature
-    root_path = []
+        if not compact_feature:
+            feature_value = G.nodes[target].get('feature', None)
+            if feature_value is not None:
+                feature_value = [x + y for x, y in zip(target_feature, feature_value)]
+                G.nodes[target]["feature"] = feature_value
+            else:
+                G.nodes[target]["feature"] = target_feature
+    root_path = 0  # call path bitmasks, every non-root node is a call path of its own
     for i, node in enumerate(list(G.nodes())):
         if node != "root":
-            G.nodes[node]["call_paths"] = [i]
-            root_path.append(i)
+            G.nodes[node]["call_paths"] = 1 << i
+            root_path |= 1 << i
     """add root node attributes"""
-    G.nodes["root"]["feature"] = [float(0)] * feature_dim[0]
+    if compact_feature:
+        set_feature_index(G, feature_occurrences)
+    else:
+        G.nodes["root"]["feature"] = [float(0)] * feature_dim[0]
     G.nodes["root"]["label"] = 0
     G.nodes["root"]["exception"] = False
     G.nodes["root"]["name"] = "root"
@@ -399,87 +459,481 @@ def construct_graph_to_nx_with_feature(file_path, event_map, file_name_map, exce
     return G
 
 
+def feature_index_from_occurrences(feature_occurrences, node_pos):
+    """(node name, event row, file name row, exception row, cost) tuples as arrays, nodes mapped by node_pos"""
+    return {
+        "node": np.array([node_pos[occ[0]] for occ in feature_occurrences], dtype=np.int64),
+        "event": np.array([occ[1] for occ in feature_occurrences], dtype=np.int64),
+        "file": np.array([occ[2] for occ in feature_occurrences], dtype=np.int64),
+        "exception": np.array([occ[3] for occ in feature_occurrences], dtype=np.int64),
+        "cost": np.array([occ[4] for occ in feature_occurrences], dtype=np.float32)}
+
+
+def set_feature_index(G, feature_occurrences):
+    """store feature occurrences as per-graph arrays, node positions follow G.nodes() order"""
+    node_pos = {node: i for i, node in enumerate(G.nodes())}
+    G.graph["feature_index"] = feature_index_from_occurrences(feature_occurrences, node_pos)
+
+
+def gather_feature_index(feature_index, num_nodes, event_map, file_name_map, exception_map):
+    """node feature matrix from feature index arrays: one gather per embedding table, summed per node by index_add"""
+    occurrence_feats = torch.cat([event_map.gather(feature_index["event"]),
+                                  file_name_map.gather(feature_index["file"]),
+                                  exception_map.gather(feature_index["exception"]),
+                                  torch.from_numpy(feature_index["cost"]).unsqueeze(1)], dim=1)
+    feats = torch.zeros((num_nodes, occurrence_feats.size(1)), dtype=torch.float)
+    feats.index_add_(0, torch.from_numpy(feature_index["node"]), occurrence_feats)
+    return feats
+
+
+def gather_node_features(G, event_map, file_name_map, exception_map):
+    """node feature matrix of a compact graph"""
+    return gather_feature_index(G.graph["feature_index"], G.number_of_nodes(), event_map, file_name_map,
+                                exception_map)
+
+
+def attach_node_features(G, event_map, file_name_map, exception_map):
+    """materialize the "feature" list of every node of a compact graph, for code working on networkx subgraphs"""
+    feats = gather_node_features(G, event_map, file_name_map, exception_map).tolist()
+    for node, feat in zip(G.nodes(), feats):
+        G.nodes[node]["feature"] = feat
+
+
+def nx_edge_index(graph, node_idx):
+    """edge_index of graph through a node -> index map built once, O(V + E) instead of list.index per edge"""
+    edges = np.fromiter((node_idx[node] for edge in graph.edges() for node in edge), dtype=np.int64,
+                        count=2 * graph.number_of_edges())
+    return torch.from_numpy(edges.reshape(-1, 2).T.copy())
+
+
+def nx_to_pyg(graph, embedding_tables=None):
+    """node features, edge_index and the node -> index map of a networkx graph, nodes in graph.nodes() order"""
+    node_idx = {node: i for i, node in enumerate(graph.nodes())}
+    # subgraph views share the parent's graph dict, so only whole compact graphs gather from the tables
+    if "feature_index" in graph.graph and not nx.is_frozen(graph):
+        feats = gather_node_features(graph, *embedding_tables)
+    else:
+        feats = torch.tensor([graph.nodes[node]["feature"] for node in graph.nodes()], dtype=torch.float)
+    return feats, nx_edge_index(graph, node_idx), node_idx
+
+
+def _add_edge(adj, u, v):
+    """mirrors nx.Graph.add_edge on a dict of dicts: new nodes are appended u first, an existing edge keeps its place"""
+    if u not in adj:
+        adj[u] = {}
+    if v not in adj:
+        adj[v] = {}
+    adj[u][v] = None
+    adj[v][u] = None
+
+
+def _adj_edge_index(adj, node_pos):
+    """edge_index in nx.Graph.edges() order, i.e. every edge once, from the node that comes first"""
+    edges = []
+    seen = set()
+    for u, nbrs in adj.items():
+        for v in nbrs:
+            if v not in seen:
+                edges.append(node_pos[u])
+                edges.append(node_pos[v])
+        seen.add(u)
+    return torch.from_numpy(np.array(edges, dtype=np.int64).reshape(-1, 2).T.copy())
+
+
+class TraceData(Data):
+    """
+    Data of a directly parsed trace. call_path_index [2, nnz] lists (node, call path) pairs grouped by node and
+    num_call_paths counts the call paths, so batching offsets both rows the way it offsets edge_index
+    """
+
+    def __inc__(self, key, value, *args, **kwargs):
+        if key == "call_path_index":
+            return torch.tensor([[self.num_nodes], [self.num_call_paths]])
+        return super().__inc__(key, value, *args, **kwargs)
+
+    def __cat_dim__(self, key, value, *args, **kwargs):
+        if key == "call_path_index":
+            return 1
+        return super().__cat_dim__(key, value, *args, **kwargs)
+
+
+def _call_path_index(call_paths):
+    """per-node lists of call path ids as a [2, nnz] (node, call path) index"""
+    rows = np.repeat(np.arange(len(call_paths), dtype=np.int64), [len(paths) for paths in call_paths])
+    cols = np.fromiter((path for paths in call_paths for path in paths), dtype=np.int64, count=rows.size)
+    return torch.from_numpy(np.stack([rows, cols]))
+
+
+def parse_tree_trace_to_data(file_path, gid, event_map, file_name_map, exception_map):
+    """
+    forum trace file straight to Data, with the same node order, features, labels, exception flags and
+    call paths as construct_tree_to_nx_with_feature + parse_graphs_to_dataset, but without networkx
+    """
+    tree = build_tree_from_txt(file_path, gid)
+    adj = {}
+    labels = {}
+    exceptions = {}
+    feature_occurrences = []
+    call_paths = {}
+    leaf_num = 0
+    chain = []
+    stack = [(tree, None, None, 0, 0)]  # node, parent name, props, label, depth
+    while stack:  # iterative pre-order, visiting children in the order the recursive traversal does
+        node, parent_name, props, label, depth = stack.pop()
+        del chain[depth:]
+        chain.append(node.name)
+        call_paths.setdefault(node.name, [])
+        if parent_name is not None:
+            _add_edge(adj, node.name, parent_name)
+            _, cost, event, exception = props.split(",")
+            feature_occurrences.append((node.name, event_map.index[event.replace("event=", "", 1)],
+                                        file_name_map.index.get(node.name.split(":")[0], -1),
+                                        exception_map.index[exception.replace("exception=", "", 1)],
+                                        float(cost.split("=")[1].split("m")[0])))
+            labels[node.name] = label
+            exceptions[node.name] = exception.replace("exception=", "", 1) != "null"
+        if len(node.children) == 0:  # leaf node, every node on the chain lies on this call path
+            for name in chain:
+                call_paths[name].append(leaf_num)
+            leaf_num += 1
+        for child, weight, child_props, child_label in reversed(node.children):
+            stack.append((child, node.name, child_props, child_label, depth + 1))
+    if "root" not in adj:
+        adj["root"] = {}
+
+    node_pos = {node: i for i, node in enumerate(adj)}
+    x = gather_feature_index(feature_index_from_occurrences(feature_occurrences, node_pos), len(adj), event_map,
+                             file_name_map, exception_map)
+    return TraceData(x=x, edge_index=_adj_edge_index(adj, node_pos),
+                     y=torch.tensor([labels.get(node, 0) for node in adj], dtype=torch.long),
+                     exception=torch.tensor([exceptions.get(node, False) for node in adj], dtype=torch.bool),
+                     call_path_index=_call_path_index([call_paths[node] for node in adj]), num_call_paths=leaf_num)
+
+
+def parse_graph_trace_to_data(file_path, event_map, file_name_map, exception_map):
+    """halo trace file straight to Data, the counterpart of construct_graph_to_nx_with_feature without networkx"""
+    adj = {}
+    labels = {}
+    exceptions = {}
+    feature_occurrences = []
+    for (target, source), cost, event, exception, label in read_graph_trace(file_path):
+        _add_edge(adj, target, source)
+        feature_occurrences.append((target, event_map.index[event.replace("event=", "", 1)],
+                                    file_name_map.index[target],
+                                    exception_map.index[exception.replace("exception=", "", 1)],
+                                    float(cost.split("=")[1].split("m")[0])))
+        labels[target] = label
+        exceptions[target] = exceptions.get(target, False) or exception.replace("exception=", "", 1) != "null"
+    labels["root"] = 0
+    exceptions["root"] = False
+
+    node_pos = {node: i for i, node in enumerate(adj)}
+    x = gather_feature_index(feature_index_from_occurrences(feature_occurrences, node_pos), len(adj), event_map,
+                             file_name_map, exception_map)
+    x[node_pos["root"]] = 0.0
+    call_paths = [[i] if node != "root" else [j for j, n in enumerate(adj) if n != "root"] for i, node in
+                  enumerate(adj)]
+    return TraceData(x=x, edge_index=_adj_edge_index(adj, node_pos),
+                     y=torch.tensor([labels.get(node, 0) for node in adj], dtype=torch.long),
+                     exception=torch.tensor([exceptions.get(node, False) for node in adj], dtype=torch.bool),
+                     call_path_index=_call_path_index(call_paths), num_call_paths=len(adj))
+
+
+def parse_trace_to_data(dataset, file_path, gid, event_map, file_name_map, exception_map):
+    """fast path for training and inference: Data(x, edge_index, y) plus exception and call path metadata"""
+    if dataset == "halo":
+        return parse_graph_trace_to_data(file_path, event_map, file_name_map, exception_map)
+    return parse_tree_trace_to_data(file_path, gid, event_map, file_name_map, exception_map)
+
+
 def parse_k_hop_graph_to_data(k_hop_subgraph, target_node_label, target_node):
 
-    feats = torch.tensor([k_hop_subgraph.nodes[node]["feature"] for node in k_hop_subgraph.nodes()], dtype=torch.float)
-    edges = [[list(k_hop_subgraph.nodes).index(u), list(k_hop_subgraph.nodes).index(v)] for u, v in
-             k_hop_subgraph.edges]
-    edge_index = np.transpose(edges).tolist()
-    data = Data(x=feats, edge_index=torch.tensor(edge_index).long(), y=torch.tensor(target_node_label).long(),
-                target_node_index=list(k_hop_subgraph.nodes()).index(target_node))
+    feats, edge_index, node_idx = nx_to_pyg(k_hop_subgraph)
+    data = Data(x=feats, edge_index=edge_index, y=torch.tensor(target_node_label).long(),
+                target_node_index=node_idx[target_node])
     return data
 
 
-def read_same_graph_structures_dict(dataset, directory, event_map, file_name_map, exception_map):
+def parse_graph_file(dataset, file_path, event_map, file_name_map, exception_map, compact_feature=False,
+                     direct_parse=False):
+    """direct_parse returns a Data object from parse_trace_to_data instead of a networkx graph"""
+    gid = os.path.basename(file_path).split("-")[0]
+    if direct_parse:
+        g = parse_trace_to_data(dataset, file_path, gid, event_map, file_name_map, exception_map)
+    elif dataset == "halo":
+        g = construct_graph_to_nx_with_feature(file_path, event_map, file_name_map, exception_map, compact_feature)
+    else:
+        root = build_tree_from_txt(file_path, gid)
+        g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map, compact_feature)
+    return gid, g, file_path
+
+
+_ingest_worker_args = None  # (dataset, event_map, file_name_map, exception_map, compact_feature, direct_parse)
+
+
+def _init_ingest_worker(dataset, event_map, file_name_map, exception_map, compact_feature, direct_parse):
+    global _ingest_worker_args  # set once per worker process
+    _ingest_worker_args = (dataset, event_map, file_name_map, exception_map, compact_feature, direct_parse)
+
+
+def _parse_graph_file_chunk(file_paths):
+    dataset, event_map, file_name_map, exception_map, compact_feature, direct_parse = _ingest_worker_args
+    return [parse_graph_file(dataset, file_path, event_map, file_name_map, exception_map, compact_feature,
+                             direct_parse) for file_path in file_paths]
+
+
+GRAPH_FORMAT_VERSION = 3  # bump when the attributes of parsed graphs change, invalidates graph caches
+
+
+def feature_maps_hash(event_map, file_name_map, exception_map, compact_feature=False, direct_parse=False):
+    feature_maps = [(table.names, table.matrix) for table in (event_map, file_name_map, exception_map)]
+    return hashlib.sha1(pickle.dumps((feature_maps, compact_feature, direct_parse))).hexdigest()
+
+
+def graph_cache_key(file_path, maps_hash):
+    """content address of a parsed graph: trace file path + mtime + size + feature map hash"""
+    stat = os.stat(file_path)
+    return hashlib.sha1(
+        f"{os.path.abspath(file_path)}|{stat.st_mtime_ns}|{stat.st_size}|{maps_hash}|{GRAPH_FORMAT_VERSION}".encode(
+            "utf8")).hexdigest()
+
+
+def read_graph_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, "rb") as file:
+            return pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        print("unreadable graph cache, rebuilding:", cache_path)
+        return {}
+
+
+def write_graph_cache(cache_path, graph_cache):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        pickle.dump(graph_cache, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)  # never leave a half-written cache behind
+
+
+def parse_graph_files(dataset, file_paths, event_map, file_name_map, exception_map, num_workers=1, chunk_size=256,
+                      compact_feature=False, direct_parse=False):
+    """parse trace files into (gid, graph, path) in file order, chunks go to a process pool if num_workers > 1"""
+    if num_workers > 1 and file_paths:
+        chunks = [file_paths[i:i + chunk_size] for i in range(0, len(file_paths), chunk_size)]
+        parsed_graphs = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_init_ingest_worker,
+                                                    initargs=(dataset, event_map, file_name_map, exception_map,
+                                                              compact_feature, direct_parse)) as executor:
+            with tqdm(total=len(file_paths)) as pbar:
+                for chunk_result in executor.map(_parse_graph_file_chunk, chunks):  # map keeps submission order
+                    parsed_graphs.extend(chunk_result)
+                    pbar.update(len(chunk_result))
+        return parsed_graphs
+    return [parse_graph_file(dataset, file_path, event_map, file_name_map, exception_map, compact_feature,
+                             direct_parse) for file_path in tqdm(file_paths)]
+
+
+def read_same_graph_structures_dict(dataset, directory, event_map, file_name_map, exception_map, num_workers=1,
+                                    chunk_size=256, cache_path=None, compact_feature=False, direct_parse=False):
+    """
+    num_workers > 1 parses chunks of files in a process pool; results merge in file order as in serial mode.
+    With cache_path, unchanged files are loaded from the graph cache and only new or modified ones are parsed.
+    """
+    file_paths = [os.path.join(directory, f) for f in os.listdir(directory) if
+                  os.path.isfile(os.path.join(directory, f))]
+    if cache_path is None:
+        parsed_graphs = parse_graph_files(dataset, file_paths, event_map, file_name_map, exception_map, num_workers,
+                                          chunk_size, compact_feature, direct_parse)
+    else:
+        graph_cache = read_graph_cache(cache_path)
+        maps_hash = feature_maps_hash(event_map, file_name_map, exception_map, compact_feature, direct_parse)
+        cache_keys = [graph_cache_key(file_path, maps_hash) for file_path in file_paths]
+        miss_paths = [file_path for file_path, key in zip(file_paths, cache_keys) if key not in graph_cache]
+        print(f"graph cache: {len(file_paths) - len(miss_paths)} hits, {len(miss_paths)} files to parse")
+        parsed_miss_graphs = iter(
+            parse_graph_files(dataset, miss_paths, event_map, file_name_map, exception_map, num_workers, chunk_size,
+                              compact_feature, direct_parse))
+        parsed_graphs = []
+        new_graph_cache = {}
+        for file_path, key in zip(file_paths, cache_keys):
+            if key in graph_cache:
+                gid, g = graph_cache[key]
+            else:
+                gid, g, _ = next(parsed_miss_graphs)
+            new_graph_cache[key] = (gid, g)
+            parsed_graphs.append((gid, g, file_path))
+        if miss_paths or len(new_graph_cache) != len(graph_cache):  # new, modified or deleted traces
+            write_graph_cache(cache_path, new_graph_cache)
 
     graph_dataset_dict = {}
-    for file in tqdm([f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]):
-        gid = file.split("-")[0]
-        if dataset == "halo":
-            g = construct_graph_to_nx_with_feature(os.path.join(directory, file), event_map, file_name_map,
-                                                   exception_map)
-        else:
-            root = build_tree_from_txt(os.path.join(directory, file), gid)
-            g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map)
+    for gid, g, file_path in parsed_graphs:
         if gid in graph_dataset_dict:
-            graph_dataset_dict[gid].append((g, os.path.join(directory, file)))
+            graph_dataset_dict[gid].append((g, file_path))
         else:
-            graph_dataset_dict[gid] = [(g, os.path.join(directory, file))]
+            graph_dataset_dict[gid] = [(g, file_path)]
     return graph_dataset_dict
 
 
-def parse_graphs_to_dataset(graphs):
-
+def read_structure_graphs(dataset, file_paths, event_map, file_name_map, exception_map, num_workers=1,
+                          chunk_size=256, cache_path=None, compact_feature=False, kept_paths=()):
+    """
+    networkx graphs of file_paths in order, for k-hop subgraphs and mcts when the datasets are parsed with
+    direct_parse. With cache_path, unchanged files are loaded from that cache and only new or modified ones are
+    parsed; cache entries of files in neither file_paths nor kept_paths are dropped
+    """
+    if cache_path is None:
+        return [g for _, g, _ in parse_graph_files(dataset, file_paths, event_map, file_name_map, exception_map,
+                                                   num_workers, chunk_size, compact_feature)]
+    graph_cache = read_graph_cache(cache_path)
+    maps_hash = feature_maps_hash(event_map, file_name_map, exception_map, compact_feature)
+    cache_keys = [graph_cache_key(file_path, maps_hash) for file_path in file_paths]
+    miss_paths = [file_path for file_path, key in zip(file_paths, cache_keys) if key not in graph_cache]
+    print(f"structure graph cache: {len(file_paths) - len(miss_paths)} hits, {len(miss_paths)} files to parse")
+    parsed_miss_graphs = iter(
+        parse_graph_files(dataset, miss_paths, event_map, file_name_map, exception_map, num_workers, chunk_size,
+                          compact_feature))
+    kept_keys = set(cache_keys) | {graph_cache_key(file_path, maps_hash) for file_path in kept_paths}
+    new_graph_cache = {key: g for key, g in graph_cache.items() if key in kept_keys}
+    graphs = []
+    for key in cache_keys:
+        if key not in new_graph_cache:
+            new_graph_cache[key] = next(parsed_miss_graphs)[1]
+        graphs.append(new_graph_cache[key])
+    if miss_paths or len(new_graph_cache) != len(graph_cache):  # new, modified or deleted traces
+        write_graph_cache(cache_path, new_graph_cache)
+    return graphs
+
+
+def parse_graphs_to_dataset(graphs, embedding_tables=None):
+    """embedding_tables = (event_map, file_name_map, exception_map), needed for compact graphs"""
     dataset = []
     for graph in graphs:
-        feats = torch.tensor([graph.nodes[node]["feature"] for node in graph.nodes()], dtype=torch.float)
-        edges = [[list(graph.nodes).index(u), list(graph.nodes).index(v)] for u, v in
-                 graph.edges]
-        edge_index = np.transpose(edges).tolist()
+        feats, edge_index, _ = nx_to_pyg(graph, embedding_tables)
         labels = torch.tensor([graph.nodes[node]["label"] for node in graph.nodes()], dtype=torch.long)
-        data = Data(x=feats, edge_index=torch.tensor(edge_index).long(), y=labels)
+        data = Data(x=feats, edge_index=edge_index, y=labels)
         dataset.append(data)
     return dataset
 
 
-def are_graphs_equal(graph1, graph2):
-
-    nodes_equal = set(graph1.nodes()) == set(graph2.nodes())
-
-    edges_equal = sorted([sorted([u, v]) for u, v in graph1.edges()]) == sorted(
-        [sorted([u, v]) for u, v in graph2.edges()])
-    return nodes_equal and edges_equal
-
-
-def get_k_hop_subgraph_of_target_node(dataset_name, graph_dataset, k, id_start):
-
+def k_hop_subgraph_fingerprint(target_node, node_names, edge_names):
+    """canonical, hashable form of a k-hop subgraph: target node, node name set and undirected edge name set"""
+    return target_node, frozenset(node_names), frozenset(edge_names)
+
+
+class KHopSubgraph:
+    """
+    k-hop subgraph kept as its parent graph plus node list, the networkx subgraph view is only built by
+    to_networkx, i.e. in the mcts workers that search it
+    """
+
+    def __init__(self, graph, node_list):
+        self.graph = graph
+        self.node_list = node_list
+
+    def number_of_nodes(self):
+        return len(self.node_list)
+
+    def to_networkx(self):
+        return self.graph.subgraph(self.node_list)
+
+
+def build_csr(src, dst, num_nodes):
+    """row pointer and the positions of the (src, dst) pairs grouped by src, pairs of one src keep their order"""
+    order = torch.argsort(src, stable=True)
+    ptr = torch.zeros(num_nodes + 1, dtype=torch.long)
+    ptr[1:] = torch.bincount(src, minlength=num_nodes).cumsum(0)
+    return ptr, order
+
+
+def csr_gather(ptr, rows):
+    """positions ptr[row]..ptr[row + 1] - 1 of every row, with the index in rows each position belongs to"""
+    degrees = ptr[rows + 1] - ptr[rows]
+    owners = torch.repeat_interleave(torch.arange(rows.numel()), degrees)
+    positions = torch.arange(int(degrees.sum())) + torch.repeat_interleave(ptr[rows] - (degrees.cumsum(0) - degrees),
+                                                                           degrees)
+    return owners, positions
+
+
+def k_hop_reach(ptr, neighbors, targets, num_nodes, k):
+    """
+    sorted keys target * num_nodes + node of the nodes within k hops of every target, a bfs from all targets at
+    once over the csr adjacency (ptr, neighbors); only reached (target, node) pairs are ever materialised
+    """
+    reached = targets * num_nodes + targets
+    frontier = reached
+    for _ in range(k):
+        owners, positions = csr_gather(ptr, frontier % num_nodes)
+        candidates = torch.unique((frontier // num_nodes)[owners] * num_nodes + neighbors[positions])
+        frontier = candidates[~torch.isin(candidates, reached)]
+        if frontier.numel() == 0:  # every neighbourhood is complete
+            break
+        reached = torch.cat([reached, frontier])
+    return torch.sort(reached).values
+
+
+def get_k_hop_subgraph_of_target_node(dataset_name, graph_dataset, k, id_start, embedding_tables=None,
+                                      chunk_size=1024):
+    """
+    k-hop subgraph of every non-root node. The neighbourhoods of chunk_size target nodes at a time are found by
+    k_hop_reach, their inner edges by looking up the parent edges of every reached node, so memory follows the
+    neighbourhood sizes. Data objects list nodes in parent graph order and keep the parent's edge directions.
+    """
     all_k_hop_subgraphs = []
+    seen_fingerprints = set()  # non-halo subgraphs equal to an earlier one with the same target node are dropped
     graph_unique_id = id_start
     for graph in graph_dataset:
-        graph_copy = copy.deepcopy(graph)
-        graph_copy_undirected = graph_copy.to_undirected()
-
-        neighbors_dict = {
-            node: list(nx.single_source_shortest_path_length(graph_copy_undirected, node, cutoff=k).keys()) for node in
-            graph_copy_undirected.nodes}
-        for target_node in graph.nodes:
-            if target_node == "root":
-                continue
-            neighbors = neighbors_dict[target_node]
-            subgraph = graph.subgraph(neighbors)
-            target_node_label = graph.nodes[target_node]["label"]
-            ok = True
-            if dataset_name != "halo":
-                for _, tar_node, _, subg, _ in all_k_hop_subgraphs:  # 过滤重复子图
-                    if tar_node == target_node and are_graphs_equal(subg, subgraph):
-                        ok = False
-                        break
-            if ok:
-                all_k_hop_subgraphs.append((graph_unique_id, target_node, target_node_label, subgraph,
-                                            parse_k_hop_graph_to_data(subgraph, target_node_label,
-                                                                      target_node)))
-                # id, target_node, label, k-hop subgraph, data object of subgraph
-                graph_unique_id += 1
+        feats, edge_index, node_idx = nx_to_pyg(graph, embedding_tables)
+        nodes = list(node_idx)
+        num_nodes = len(nodes)
+        undirected_edge_index = torch.cat([edge_index, edge_index.flip(0)], dim=1)
+        adj_ptr, adj_order = build_csr(undirected_edge_index[0], undirected_edge_index[1], num_nodes)
+        adj_neighbors = undirected_edge_index[1][adj_order]
+        out_edge_ptr, out_edge_order = build_csr(edge_index[0], edge_index[1], num_nodes)  # parent edges by source
+        if dataset_name != "halo":
+            edge_names = [frozenset((nodes[u], nodes[v])) for u, v in edge_index.t().tolist()]
+        for chunk_start in range(0, num_nodes, chunk_size):
+            targets = torch.arange(chunk_start, min(chunk_start + chunk_size, num_nodes))
+            reached = k_hop_reach(adj_ptr, adj_neighbors, targets, num_nodes, k)
+            reach_targets, reach_nodes = reached // num_nodes, reached % num_nodes
+            counts = torch.bincount(reach_targets - chunk_start, minlength=targets.numel())
+            group_starts = counts.cumsum(0) - counts
+            subsets = reach_nodes.split(counts.tolist())
+            # inner edges: parent edges out of a reached node whose other end is reached for the same target
+            owners, positions = csr_gather(out_edge_ptr, reach_nodes)
+            edge_pos = out_edge_order[positions]
+            edge_targets = reach_targets[owners]
+            dst_keys = edge_targets * num_nodes + edge_index[1, edge_pos]
+            dst_found = torch.searchsorted(reached, dst_keys).clamp(max=reached.numel() - 1)
+            inner = reached[dst_found] == dst_keys
+            edge_pos, edge_targets, dst_found = edge_pos[inner], edge_targets[inner], dst_found[inner]
+            edge_order = torch.argsort(edge_targets * edge_index.size(1) + edge_pos)  # parent edge order per target
+            edge_pos, edge_targets, dst_found = edge_pos[edge_order], edge_targets[edge_order], dst_found[edge_order]
+            src_found = torch.searchsorted(reached, edge_targets * num_nodes + edge_index[0, edge_pos])
+            starts = group_starts[edge_targets - chunk_start]
+            edge_counts = torch.bincount(edge_targets - chunk_start, minlength=targets.numel()).tolist()
+            sub_edge_indices = torch.stack([src_found - starts, dst_found - starts]).split(edge_counts, dim=1)
+            sub_edge_pos = edge_pos.split(edge_counts)
+            target_node_indices = (torch.searchsorted(reached, targets * num_nodes + targets) - group_starts).tolist()
+            for chunk_pos, target_pos in enumerate(targets.tolist()):
+                target_node = nodes[target_pos]
+                if target_node == "root":
+                    continue
+                subgraph = KHopSubgraph(graph, [nodes[i] for i in subsets[chunk_pos].tolist()])
+                target_node_label = graph.nodes[target_node]["label"]
+                ok = True
+                if dataset_name != "halo":  # 过滤重复子图
+                    fingerprint = k_hop_subgraph_fingerprint(target_node, subgraph.node_list,
+                                                             [edge_names[i] for i in sub_edge_pos[chunk_pos].tolist()])
+                    ok = fingerprint not in seen_fingerprints
+                    seen_fingerprints.add(fingerprint)
+                if ok:
+                    data = Data(x=feats[subsets[chunk_pos]], edge_index=sub_edge_indices[chunk_pos].clone(),
+                                y=torch.tensor(target_node_label).long(),
+                                target_node_index=target_node_indices[chunk_pos])
+                    all_k_hop_subgraphs.append((graph_unique_id, target_node, target_node_label, subgraph, data))
+                    # id, target_node, label, k-hop subgraph, data object of subgraph
+                    graph_unique_id += 1
 
     return all_k_hop_subgraphs
 
@@ -536,7 +990,8 @@ def write_train_val_test_set_paths(train_set_paths, val_set_paths, test_set_path
             file.write(str(g_id) + " : " + p + "\n")
 
 
-def load_specific_train_val_test_set(dataset, dataset_path, event_map, file_name_map, exception_map, n):
+def load_specific_train_val_test_set(dataset, dataset_path, event_map, file_name_map, exception_map, n,
+                                     compact_feature=False):
 
     with open(dataset_path, 'r', encoding='utf8') as file:
         lines = file.readlines()
@@ -557,20 +1012,23 @@ def load_specific_train_val_test_set(dataset, dataset_path, event_map, file_name
         if gid not in gid_num_dict:
             gid_num_dict[gid] = 1
             if dataset == "halo":
-                g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map)
+                g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map,
+                                                       compact_feature)
             else:
                 root = build_tree_from_txt(path, gid)
-                g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map)
+                g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map, compact_feature)
             train_graph_set.append(g)
             train_graph_struc_set[gid] = g
         else:
             if n == 0 or gid_num_dict[gid] < n:
                 gid_num_dict[gid] = gid_num_dict[gid] + 1
                 if dataset == "halo":
-                    g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map)
+                    g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map,
+                                                           compact_feature)
                 else:
                     root = build_tree_from_txt(path, gid)
-                    g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map)
+                    g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map,
+                                                          compact_feature)
                 train_graph_set.append(g)
                 train_graph_struc_set[gid] = g
     for line in val_paths:
@@ -578,27 +1036,31 @@ def load_specific_train_val_test_set(dataset, dataset_path, event_map, file_name
         if gid not in gid_num_dict:
             gid_num_dict[gid] = 1
             if dataset == "halo":
-                g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map)
+                g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map,
+                                                       compact_feature)
             else:
                 root = build_tree_from_txt(path, gid)
-                g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map)
+                g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map, compact_feature)
             val_graph_set.append(g)
         else:
             if n == 0 or gid_num_dict[gid] < n:
                 gid_num_dict[gid] = gid_num_dict[gid] + 1
                 if dataset == "halo":
-                    g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map)
+                    g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map,
+                                                           compact_feature)
                 else:
                     root = build_tree_from_txt(path, gid)
-                    g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map)
+                    g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map,
+                                                          compact_feature)
                 val_graph_set.append(g)
     for line in test_paths:
         gid, path = line.split(" : ")
         if dataset == "halo":
-            g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map)
+            g = construct_graph_to_nx_with_feature(path, event_map, file_name_map, exception_map,
+                                                   compact_feature)
         else:
             root = build_tree_from_txt(path, gid)
-            g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map)
+            g = construct_tree_to_nx_with_feature(root, event_map, file_name_map, exception_map, compact_feature)
         test_graph_set.append(g)
         test_graph_set_unique[gid] = g
     train_graph_struc_set = [g for gid, g in train_graph_struc_set.items()]
@@ -607,7 +1069,13 @@ def load_specific_train_val_test_set(dataset, dataset_path, event_map, file_name
 
 
 def load_dataset(dataset_name, dataset_id, use_specific_dataset, most_n_same_graph_structure, train_set_ratio,
-                 val_set_ratio, dataloader_shuffle, batch_size, k):
+                 val_set_ratio, dataloader_shuffle, batch_size, k, ingest_workers=1, use_graph_cache=True,
+                 compact_feature=False, direct_parse=False):
+    """
+    direct_parse reads train/val/test traces straight into Data objects, only the train structure graphs used
+    for k-hop subgraphs and mcts are built as networkx graphs. It applies when use_specific_dataset is False.
+    compact_feature applies to the networkx graphs, so with direct_parse only to the train structure graphs.
+    """
 
     dataset_dir = f"./{dataset_name}_dataset"
     root = f"./{dataset_name}_data"
@@ -620,18 +1088,25 @@ def load_dataset(dataset_name, dataset_id, use_specific_dataset, most_n_same_gra
         one_hot_length = 161
     else:
         raise ValueError("not supportive dataset name for one ont length.")
-    event_map = read_event_one_hot(event_embedding_path, one_hot_length)
-    file_name_map = read_file_one_hot(file_embedding_path, one_hot_length)
-    exception_map = read_exception_one_hot(exception_embedding_path, one_hot_length)
+    event_map = read_embedding_table(event_embedding_path, one_hot_length)
+    file_name_map = read_embedding_table(file_embedding_path, one_hot_length)
+    exception_map = read_embedding_table(exception_embedding_path, one_hot_length)
     specific_train_val_test_set_path = root + f"/specific_dataset_{dataset_id}.txt"
+    graph_cache_path = root + "/graph_cache.pkl"
+    structure_graph_cache_path = root + "/structure_graph_cache.pkl"  # networkx train structure graphs, direct_parse
 
+    direct_parse = direct_parse and not use_specific_dataset
     if use_specific_dataset:
         train_graph_set, val_graph_set, test_graph_set, test_graph_set_unique, train_graph_struc_set = load_specific_train_val_test_set(
             dataset_name,
-            specific_train_val_test_set_path, event_map, file_name_map, exception_map, most_n_same_graph_structure)
+            specific_train_val_test_set_path, event_map, file_name_map, exception_map, most_n_same_graph_structure,
+            compact_feature)
     else:
         all_graphs_dict = read_same_graph_structures_dict(dataset_name, dataset_dir, event_map, file_name_map,
-                                                          exception_map)
+                                                          exception_map, num_workers=ingest_workers,
+                                                          cache_path=graph_cache_path if use_graph_cache else None,
+                                                          compact_feature=compact_feature, direct_parse=direct_parse)
+        graph_paths = {id(g): path for same_graphs in all_graphs_dict.values() for g, path in same_graphs}
 
         train_graph_set, val_graph_set, test_graph_set, test_graph_set_unique, train_graph_struc_set, train_set_paths, val_set_paths, test_set_paths = split_train_val_test_set(
             train_set_ratio,
@@ -643,7 +1118,8 @@ def load_dataset(dataset_name, dataset_id, use_specific_dataset, most_n_same_gra
         candidate_positive = []
         candidate_negative = []
         for g in train_graph_struc_set:
-            if any(node_data['label'] == 1 for node_data in g.nodes.values()):
+            if (bool((g.y == 1).any()) if direct_parse else any(
+                    node_data['label'] == 1 for node_data in g.nodes.values())):
                 candidate_positive.append(g)
             else:
                 candidate_negative.append(g)
@@ -656,13 +1132,29 @@ def load_dataset(dataset_name, dataset_id, use_specific_dataset, most_n_same_gra
         f"train graph num: {len(train_graph_set)}, validation graph num:{len(val_graph_set)}, test graph num:{len(test_graph_set)}, train graph structure num: {len(train_graph_struc_set)}")
 
 
-    train_dataset = parse_graphs_to_dataset(train_graph_set)
-    val_dataset = parse_graphs_to_dataset(val_graph_set)
-    test_dataset = parse_graphs_to_dataset(test_graph_set)
-    test_dataset_unique = parse_graphs_to_dataset(test_graph_set_unique)
-    train_prot_dataset = parse_graphs_to_dataset(train_graph_struc_set)
+    embedding_tables = (event_map, file_name_map, exception_map)
+    if direct_parse:
+        train_dataset, val_dataset, test_dataset = train_graph_set, val_graph_set, test_graph_set
+        test_dataset_unique = test_graph_set_unique
+        train_prot_dataset = train_graph_struc_set
+        train_graph_struc_set = read_structure_graphs(
+            dataset_name, [graph_paths[id(data)] for data in train_graph_struc_set], event_map, file_name_map,
+            exception_map, num_workers=ingest_workers,
+            cache_path=structure_graph_cache_path if use_graph_cache else None, compact_feature=compact_feature,
+            kept_paths=graph_paths.values())
+    else:
+        train_dataset = parse_graphs_to_dataset(train_graph_set, embedding_tables)
+        val_dataset = parse_graphs_to_dataset(val_graph_set, embedding_tables)
+        test_dataset = parse_graphs_to_dataset(test_graph_set, embedding_tables)
+        test_dataset_unique = parse_graphs_to_dataset(test_graph_set_unique, embedding_tables)
+        train_prot_dataset = parse_graphs_to_dataset(train_graph_struc_set, embedding_tables)
+
+    if compact_feature:  # k-hop subgraphs and mcts read node features from networkx attributes
+        for g in train_graph_struc_set:
+            attach_node_features(g, *embedding_tables)
 
-    train_k_hop_graphs = get_k_hop_subgraph_of_target_node(dataset_name, train_graph_struc_set, k=k, id_start=0)
+    train_k_hop_graphs = get_k_hop_subgraph_of_target_node(dataset_name, train_graph_struc_set, k=k, id_start=0,
+                                                           embedding_tables=embedding_tables)
 
     print("k hop train graph number:", len(train_k_hop_graphs))
     train_prot_dataloader = DataLoader(train_prot_dataset, batch_size=len(train_prot_dataset),
@@ -24,7 +24,9 @@ def avg_min_dist(prototype1, prototype2):
 
 def compute_estimated_prototype_layer(train_prot_dataloader, rollout_num, min_atoms, k_hop_graphs, gnnNet,
                                       prototype_num_each_class, random_negative_sample, device, mcts_pruning_strategy,
-                                      mcts_stop_strategy, k_neighbors, mcts_top_bound, mcts_prot_selection):
+                                      mcts_stop_strategy, k_neighbors, mcts_top_bound, mcts_prot_selection,
+                                      mcts_knn_index, mcts_workers, mcts_chunks_per_worker, mcts_trees,
+                                      mcts_reuse_rollout_num, mcts_budgets):
     gnnNet.eval()
     print("%-----estimated prototype layer-----%")
     output.append("%-----estimated prototype layer-----%")
@@ -33,7 +35,13 @@ def compute_estimated_prototype_layer(train_prot_dataloader, rollout_num, min_at
                                          gnnNet.GNN,
                                          prototype_num_each_class,
                                          random_negative_sample, device, mcts_pruning_strategy,
-                                         mcts_stop_strategy, k_neighbors, mcts_top_bound, mcts_prot_selection)
+                                         mcts_stop_strategy, k_neighbors, mcts_top_bound, mcts_prot_selection,
+                                         mcts_knn_index, mcts_workers, mcts_chunks_per_worker, mcts_trees,
+                                         mcts_reuse_rollout_num, **mcts_budgets)
+    if estimated_prototype_layer is None:  # searches out of budget left a class short of candidates
+        print("not enough prototype candidates for every class, keeping the previous estimated prototype layer")
+        output.append("not enough prototype candidates for every class, keeping the previous estimated prototype layer")
+        return None
     estimated_prototype_layer = estimated_prototype_layer.to(device)
     print("estimated prototype layer:")
     output.append("estimated prototype layer:")
@@ -253,6 +261,21 @@ if __name__ == '__main__':
                         default=6)
     parser.add_argument('--representation_num', type=int, help='the number of substructure representations', default=50)
     parser.add_argument('--dataset', type=str, default='halo', help='dataset name: forum/halo')
+    parser.add_argument('--ingest_workers', type=int, default=1,
+                        help='number of processes parsing raw trace files, 1 means serial')
+    parser.add_argument('--mcts_workers', type=int, default=None,
+                        help='number of mcts search processes, all cpu cores by default')
+    parser.add_argument('--mcts_chunks_per_worker', type=int, default=4,
+                        help='mcts tasks are grouped into about this many chunks of equal estimated cost per worker')
+    parser.add_argument('--mcts_patience', type=int, default=None,
+                        help='stop the search of a subgraph once its top candidates have not changed for this many rollouts')
+    parser.add_argument('--mcts_time_budget', type=float, default=None,
+                        help='seconds for all mcts searches of one mcts epoch, counted once the mcts workers have '
+                             'started, no limit by default')
+    parser.add_argument('--mcts_subgraph_time_budget', type=float, default=None,
+                        help='seconds for the mcts search of one subgraph, no limit by default')
+    parser.add_argument('--mcts_rollout_budget', type=int, default=None,
+                        help='rollouts for all mcts searches of one mcts epoch, no limit by default')
 
     args = parser.parse_args()
 
@@ -274,11 +297,17 @@ if __name__ == '__main__':
     most_n_same_graph_structure = 0
     k = len(gnn_hidden_dim)
     use_specific_dataset = False
+    use_graph_cache = True  # reuse parsed graphs of unchanged trace files from ./{dataset}_data/*graph_cache.pkl
+    # keep embedding row indices per networkx graph instead of a feature list per node, with direct_parse only the
+    # train structure graphs are networkx graphs
+    compact_node_feature = True
+    direct_parse = True  # parse train/val/test traces straight to tensors, networkx only for k-hop subgraphs and mcts
     dataloader_shuffle = True
     batch_size = args.bs
     train_dataloader, val_dataloader, test_dataloader, test_dataloader_unique, train_prot_dataloader, train_k_hop_graphs = load_dataset(
         dataset_name, 0, use_specific_dataset, most_n_same_graph_structure, train_set_ratio,
-        val_set_ratio, dataloader_shuffle, batch_size, k)
+        val_set_ratio, dataloader_shuffle, batch_size, k, args.ingest_workers, use_graph_cache,
+        compact_node_feature, direct_parse)
     for pruning_strategy in ["soft_pruning"]:
         output = []  # results
         lr = 1e-3
@@ -296,6 +325,9 @@ if __name__ == '__main__':
         mcts_stop_strategy = "specific_size"
         min_atoms = 4
         k_neighbors = 200
+        mcts_knn_index = "exact"  # exact/ivf, ivf scans only the nearest inverted lists for knn rewards, worth it from ~100k training nodes
+        mcts_reuse_trees = True  # keep the search trees between mcts epochs, later epochs re-score their path nodes
+        mcts_reuse_rollout_num = 0  # rollouts on a reused tree after re-scoring, 0 skips searching it again
         gnnNet = SLADGNN(gnn_head_num, gnn_dropout, activation_fuc, gnn_type, gnn_input_dim, gnn_hidden_dim,
                          num_of_class,
                          repre_num_of_each_class,
@@ -306,6 +338,10 @@ if __name__ == '__main__':
         optimizer = torch.optim.Adam(params=gnnNet.parameters(), lr=lr)
         "%----------start training------------%"
         estimated_prot_layer = None
+        mcts_trees = {} if mcts_reuse_trees else None
+        mcts_budgets = {"mcts_patience": args.mcts_patience, "mcts_time_budget": args.mcts_time_budget,
+                        "mcts_subgraph_time_budget": args.mcts_subgraph_time_budget,
+                        "mcts_rollout_budget": args.mcts_rollout_budget}
         train_avg_loss = []
         train_crstent_loss = []
         train_prot_loss = []
@@ -323,14 +359,19 @@ if __name__ == '__main__':
                     output.append(str(new_p))
 
             if epoch in mcts_prot_epoch:
-                estimated_prot_layer = compute_estimated_prototype_layer(train_prot_dataloader, rollout_num,
-                                                                         min_atoms,
-                                                                         train_k_hop_graphs,
-                                                                         gnnNet, repre_num_of_each_class,
-                                                                         random_negative_sample_mcts,
-                                                                         device, mcts_pruning_strategy,
-                                                                         mcts_stop_strategy, k_neighbors,
-                                                                         mcts_top_bound, mcts_prot_selection)
+                new_estimated_prot_layer = compute_estimated_prototype_layer(train_prot_dataloader, rollout_num,
+                                                                             min_atoms,
+                                                                             train_k_hop_graphs,
+                                                                             gnnNet, repre_num_of_each_class,
+                                                                             random_negative_sample_mcts,
+                                                                             device, mcts_pruning_strategy,
+                                                                             mcts_stop_strategy, k_neighbors,
+                                                                             mcts_top_bound, mcts_prot_selection,
+                                                                             mcts_knn_index, args.mcts_workers,
+                                                                             args.mcts_chunks_per_worker, mcts_trees,
+                                                                             mcts_reuse_rollout_num, mcts_budgets)
+                if new_estimated_prot_layer is not None:
+                    estimated_prot_layer = new_estimated_prot_layer
 
             train(gnnNet, train_dataloader, estimated_prot_layer)
             print("train avg loss history:\n", train_avg_loss)
@@ -1,184 +1,323 @@
+import copy
+import heapq
 import math
+import multiprocessing
+import os
 import random
+import time
 
 import torch
-import networkx as nx
-from sklearn.cluster import KMeans
 
 from torch_geometric.data import Data, Batch
 import numpy as np
-from collections import Counter
 
 from tqdm import tqdm
 import concurrent.futures
 
+from slad_dataloader import KHopSubgraph, csr_gather, nx_to_pyg
 
-class MCTSNode():
 
-    def __init__(self, coalition: list,
-                 ori_graph: nx.Graph, c_puct: float = 10.0,
-                 W: float = 0, C: int = 0, R: float = 0, alpha_e: float = 1000.0, alpha_c: float = 1000.0):
-        # self.data = data
-        self.coalition = coalition
-        self.ori_graph = ori_graph
+class MCTSTree:
+    """
+    search tree of one k-hop graph as arrays: node i has coalition coalitions[i], a bitmask over node_names
+    (the sorted k-hop graph nodes), child ids children[i], total reward W[i], count of being selected C[i],
+    immediate reward R[i] and the E / CC priors derived from its exception and call chain counts.
+    path_nodes keeps the nodes met in decision paths, the candidates for prototypes
+    """
+
+    def __init__(self, node_names, c_puct=10.0, alpha_e=1000.0, alpha_c=1000.0, capacity=64):
+        self.node_names = node_names
+        self.node_pos = {node: i for i, node in enumerate(node_names)}
         self.c_puct = c_puct  # control the trade-off between exploration and exploitation
-        self.children = []
-        self.W = W  # total reward
-        self.C = C  # count of being selected
-        self.R = R  # immediate reward
         self.alpha_e = alpha_e  # considering if pruning nodes with exception info
         self.alpha_c = alpha_c  # considering if pruning nodes in same call chain to target node
-
-    def Q(self):
-        return self.W / self.C if self.C > 0 else 0
-
-    def U(self, n):
-        return self.c_puct * self.R * math.sqrt(n) / (1 + self.C)
-
-    def E(self):
+        self.coalitions = []
+        self.children = []
+        self.state_map = {}  # coalition bitmask -> node id, merges the same sub-graph reached along different paths
+        self.path_nodes = {}  # coalition bitmask -> node id
+        self.W = np.zeros(capacity)
+        self.C = np.zeros(capacity, dtype=np.int64)
+        self.R = np.zeros(capacity)
+        self.exception_count = np.zeros(capacity, dtype=np.int64)
+        self.chain_count = np.zeros(capacity, dtype=np.int64)
+        self.exception_prior = np.zeros(capacity)
+        self.chain_prior = np.zeros(capacity)
+
+    def __len__(self):
+        return len(self.coalitions)
+
+    def add_node(self, coalition, exception_count, chain_count):
+        node_id = len(self.coalitions)
+        if node_id == self.W.size:  # arrays grow by doubling
+            for name in ["W", "C", "R", "exception_count", "chain_count", "exception_prior", "chain_prior"]:
+                array = getattr(self, name)
+                setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.coalitions.append(coalition)
+        self.children.append([])
+        self.state_map[coalition] = node_id
+        self.exception_count[node_id] = exception_count
+        self.chain_count[node_id] = chain_count
+        self.exception_prior[node_id] = self.alpha_e * (exception_count / len(self.node_names))
+        self.chain_prior[node_id] = self.alpha_c * (chain_count / len(self.node_names))
+        return node_id
+
+    def coalition_nodes(self, node_id):
+        """node names of a coalition, sorted"""
+        bits = bin(self.coalitions[node_id])[:1:-1]  # lowest bit first
+        return [node for node, bit in zip(self.node_names, bits) if bit == "1"]
+
+    def coalition_size(self, node_id):
+        return bin(self.coalitions[node_id]).count("1")
+
+    def Q(self, node_ids):
+        W, C = self.W[node_ids], self.C[node_ids]
+        return np.divide(W, C, out=np.zeros_like(W), where=C > 0)
+
+    def U(self, node_ids, n):
+        return self.c_puct * self.R[node_ids] * math.sqrt(n) / (1 + self.C[node_ids])
+
+    def E(self, node_ids):
         """try to not remove nodes first which have exception info"""
-        cur_subgraph_exception_count = len(
-            [node for node in self.coalition if self.ori_graph.nodes[node]["exception"] == True])
-        return self.alpha_e * (cur_subgraph_exception_count / self.ori_graph.number_of_nodes())
+        return self.exception_prior[node_ids]
 
-    def CC(self, target_node):
+    def CC(self, node_ids):
         """try to not remove nodes first which is not in same call chain with target node"""
-        target_node_paths = self.ori_graph.nodes[target_node]["call_paths"]
-        node_count_in_chain = 0
-        for cand_node in self.coalition:
-            cand_node_paths = self.ori_graph.nodes[cand_node]["call_paths"]
-            if set(cand_node_paths) & set(target_node_paths):
-                node_count_in_chain += 1
-        return self.alpha_c * (node_count_in_chain / self.ori_graph.number_of_nodes())
-
+        return self.chain_prior[node_ids]
 
-def mcts_rollout(k_neighbors, all_node_embeddings, all_node_labels, mcts_stop_strategy,
-                 reward_list_in_decision_path, mcts_pruning_strategy,
-                 current_MCT_node,
-                 state_map, subgraph_embedding_dict,
-                 k_hop_input_graph, min_atoms,
-                 target_node, target_node_label, gnnNet, decision_path_nodes):
-    cur_graph_coalition = current_MCT_node.coalition
-    if mcts_stop_strategy == "auto":
-        if len(reward_list_in_decision_path) > 5:  # path length must > 5
-            avg_reward = sum(reward_list_in_decision_path[:-1]) / len(reward_list_in_decision_path[:-1])
-            if reward_list_in_decision_path[-1] < avg_reward or len(cur_graph_coalition) <= 3:
-                # if last node's reward, in path, is smaller than average reward of the previous nodes of the last node
-                return
-    elif mcts_stop_strategy == "specific_size":
-        if len(cur_graph_coalition) <= min_atoms:
-            return
-    else:
-        raise ValueError("not supportive mcts stop strategy.")
-
-    # Expand if this node has never been visited
-    if len(current_MCT_node.children) == 0:
-        node_degree_list = list(
-            k_hop_input_graph.subgraph(cur_graph_coalition).degree)  # 子图的节点度，like [(node0, 2), (node1, 1)]
-        node_degree_list = sorted(node_degree_list, key=lambda x: x[1],
-                                  reverse=False)
-        all_nodes = [x[0] for x in node_degree_list]
-
-        expand_nodes = [x[0] for x in node_degree_list if x[1] == node_degree_list[0][1]]
-        if target_node in expand_nodes:
-            expand_nodes.remove(target_node)
-            if not expand_nodes:
-                expand_nodes = [x[0] for x in node_degree_list if
-                                x[1] == node_degree_list[1][1]]
+    def pruned(self):
         """
-        strategy: try not to prune the node 
-        that is either in same call path with target node or exception info node
+        a copy with only the root and the decision path nodes, the ones with visit counts and the candidates for
+        prototypes. Children lists are dropped: a kept node expands again when it is reached, which links it back to
+        its kept children through state_map and scores the never selected ones afresh
         """
-        if mcts_pruning_strategy == "normal":
-            no_prune_nodes = []
-            current_g = k_hop_input_graph.subgraph(cur_graph_coalition)
-            target_node_paths = current_g.nodes[target_node]["call_paths"]
-            for cand_node in expand_nodes:
-                cand_node_paths = current_g.nodes[cand_node]["call_paths"]
-                if (set(cand_node_paths) & set(target_node_paths)) or current_g.nodes[cand_node]["exception"] == True:
-                    no_prune_nodes.append(cand_node)
-            """如果有可以剪枝的点"""
-            if len(no_prune_nodes) != len(expand_nodes):
-                expand_nodes = [element for element in expand_nodes if element not in no_prune_nodes]
-
-        for each_node in expand_nodes:
-            # for each node, pruning it and get the remaining sub-graph
-            # here we check the resulting sub-graphs and only keep the largest one
-            subgraph_coalition = [node for node in all_nodes if node != each_node]
-            new_graph_coalition = sorted(subgraph_coalition)
-            # check the state map and merge the same sub-graph
-            Find_same = False
-            for old_graph_node in state_map.values():
-                if Counter(old_graph_node.coalition) == Counter(new_graph_coalition):
-                    new_node = old_graph_node
-                    Find_same = True
+        tree = MCTSTree(self.node_names, self.c_puct, self.alpha_e, self.alpha_c,
+                        capacity=max(1, len(self.path_nodes) + 1))
+        for node_id in [0] + sorted(self.path_nodes.values()):
+            new_node_id = tree.add_node(self.coalitions[node_id], self.exception_count[node_id],
+                                        self.chain_count[node_id])
+            tree.W[new_node_id] = self.W[node_id]
+            tree.C[new_node_id] = self.C[node_id]
+            tree.R[new_node_id] = self.R[node_id]
+        tree.path_nodes = {coalition: tree.state_map[coalition] for coalition in self.path_nodes}
+        return tree
+
+
+class CoalitionDegrees:
+    """
+    degrees of the nodes of a coalition inside the k-hop graph by node position, with the positions kept in
+    buckets by degree; pruning one node only touches its neighbours, so no subgraph view is built per step
+    """
+
+    def __init__(self, degrees, neighbors):
+        self.degrees = degrees  # -1 once the node is pruned
+        self.neighbors = neighbors  # neighbour positions of every position, once per edge
+        self.buckets = [set() for _ in range(max(degrees, default=0) + 1)]
+        for pos, degree in enumerate(degrees):
+            if degree >= 0:
+                self.buckets[degree].add(pos)
+
+    @classmethod
+    def of_graph(cls, graph, node_pos):
+        """degrees of the whole graph, i.e. of the root coalition"""
+        degrees = [0] * len(node_pos)
+        for node, degree in graph.degree:
+            degrees[node_pos[node]] = degree
+        neighbors = [[] for _ in range(len(node_pos))]
+        for u, v in graph.edges():
+            if u != v:  # a self loop only goes away with the node itself
+                neighbors[node_pos[u]].append(node_pos[v])
+                neighbors[node_pos[v]].append(node_pos[u])
+        return cls(degrees, neighbors)
+
+    def copy(self):
+        return CoalitionDegrees(list(self.degrees), self.neighbors)
+
+    def remove(self, pos):
+        self.buckets[self.degrees[pos]].discard(pos)
+        self.degrees[pos] = -1
+        for neighbor in self.neighbors[pos]:
+            degree = self.degrees[neighbor]
+            if degree > 0:
+                self.buckets[degree].discard(neighbor)
+                self.buckets[degree - 1].add(neighbor)
+                self.degrees[neighbor] = degree - 1
+
+    def lowest(self, n=2):
+        """positions of the n lowest non-empty degree buckets, each sorted"""
+        res = []
+        for bucket in self.buckets:
+            if bucket:
+                res.append(sorted(bucket))
+                if len(res) == n:
                     break
+        return res
 
-            if Find_same == False:
-                new_node = MCTSNode(new_graph_coalition, ori_graph=k_hop_input_graph)
-                state_map[str(new_graph_coalition)] = new_node
 
-            Find_same_child = False
-            for cur_child in current_MCT_node.children:
-                if Counter(cur_child.coalition) == Counter(new_graph_coalition):
-                    Find_same_child = True
-                    break
+def node_prior_counts(ori_graph, node, target_node_paths):
+    """(has exception info, shares a call path with the target node) of one node as 0/1 counts"""
+    node_attrs = ori_graph.nodes[node]
+    return int(node_attrs["exception"] == True), int(bool(node_attrs["call_paths"] & target_node_paths))
 
-            if Find_same_child == False:
-                current_MCT_node.children.append(new_node)
-
-        for child in current_MCT_node.children:
-            if str(child.coalition) not in subgraph_embedding_dict:
-                score, subgraph_emb = subgraph_score(k_neighbors, all_node_embeddings, all_node_labels,
-                                                     target_node, target_node_label,
-                                                     child.coalition,
-                                                     k_hop_input_graph,
-                                                     gnnNet)
-                child.R = score
-                subgraph_embedding_dict[str(child.coalition)] = subgraph_emb
-
-    sum_count = sum([c.C for c in current_MCT_node.children])
-    """pruning strategy: Q + U/ Q + U + E + CC"""
-    if mcts_pruning_strategy == "soft_pruning":
-        next_node_candidates = []
-
-        possible_selected_MCT_node = max(current_MCT_node.children,
-                                         key=lambda x: x.Q() + x.U(sum_count) + x.E() + x.CC(target_node))
-        max_value = possible_selected_MCT_node.Q() + possible_selected_MCT_node.U(
-            sum_count) + possible_selected_MCT_node.E() + possible_selected_MCT_node.CC(target_node)
-        for node in current_MCT_node.children:
-            if (node.Q() + node.U(sum_count) + node.E() + node.CC(target_node)) == max_value:
-                next_node_candidates.append(node)
-        selected_MCT_node = random.choice(next_node_candidates)
-    elif mcts_pruning_strategy == "normal" or mcts_pruning_strategy == "original":
-        next_node_candidates = []
-
-        possible_selected_MCT_node = max(current_MCT_node.children, key=lambda x: x.Q() + x.U(sum_count))
-        max_value = possible_selected_MCT_node.Q() + possible_selected_MCT_node.U(sum_count)
-        for node in current_MCT_node.children:
-            if (node.Q() + node.U(sum_count)) == max_value:
-                next_node_candidates.append(node)
-        selected_MCT_node = random.choice(next_node_candidates)
-    elif mcts_pruning_strategy == "random":
-        selected_MCT_node = random.choice(current_MCT_node.children)
-    else:
-        raise ValueError("not supportive mcts strategy.")
-    """Update value"""
-    decision_path_nodes.append(selected_MCT_node)
-    reward_list_in_decision_path.append(selected_MCT_node.R)
-    mcts_rollout(k_neighbors, all_node_embeddings, all_node_labels, mcts_stop_strategy,
-                 reward_list_in_decision_path, mcts_pruning_strategy,
-                 selected_MCT_node,
-                 state_map, subgraph_embedding_dict,
-                 k_hop_input_graph, min_atoms,
-                 target_node, target_node_label, gnnNet, decision_path_nodes)
-    return
+
+def coalition_prior_counts(ori_graph, coalition, target_node):
+    """exception and call chain counts of a whole coalition, only scanned for the root of a search"""
+    target_node_paths = ori_graph.nodes[target_node]["call_paths"]  # call path bitmask
+    exception_count, chain_count = 0, 0
+    for node in coalition:
+        node_exception, node_in_chain = node_prior_counts(ori_graph, node, target_node_paths)
+        exception_count += node_exception
+        chain_count += node_in_chain
+    return exception_count, chain_count
 
 
-def mcts_single_subgraph_in_parallel(k_neighbors, all_node_embeddings, all_node_labels,
+def mcts_rollout(k_neighbors, node_embedding_index, all_node_labels, mcts_stop_strategy,
+                 reward_list_in_decision_path, mcts_pruning_strategy,
+                 tree, current_node_id, coalition_degrees, subgraph_embedding_dict,
+                 k_hop_input_graph, min_atoms,
+                 target_node, target_node_label, gnnNet, decision_path_nodes):
+    """
+    one rollout from current_node_id down to a stop, appending the ids of selected tree nodes to decision_path_nodes,
+    coalition_degrees belongs to current_node_id and is updated in place along the path
+    """
+    target_node_paths = k_hop_input_graph.nodes[target_node]["call_paths"]
+    while True:
+        cur_graph_coalition_size = tree.coalition_size(current_node_id)
+        if mcts_stop_strategy == "auto":
+            if len(reward_list_in_decision_path) > 5:  # path length must > 5
+                avg_reward = sum(reward_list_in_decision_path[:-1]) / len(reward_list_in_decision_path[:-1])
+                if reward_list_in_decision_path[-1] < avg_reward or cur_graph_coalition_size <= 3:
+                    # if last node's reward, in path, is smaller than average reward of the previous nodes of the
+                    # last node
+                    return
+        elif mcts_stop_strategy == "specific_size":
+            if cur_graph_coalition_size <= min_atoms:
+                return
+        else:
+            raise ValueError("not supportive mcts stop strategy.")
+
+        # Expand if this node has never been visited
+        if len(tree.children[current_node_id]) == 0:
+            # nodes with the lowest degree in the current sub-graph, in node order
+            lowest_degree_buckets = coalition_degrees.lowest()
+            expand_nodes = [tree.node_names[pos] for pos in lowest_degree_buckets[0]]
+            if target_node in expand_nodes:
+                expand_nodes.remove(target_node)
+                if not expand_nodes:
+                    expand_nodes = [tree.node_names[pos] for pos in lowest_degree_buckets[1]]
+            """
+            strategy: try not to prune the node 
+            that is either in same call path with target node or exception info node
+            """
+            if mcts_pruning_strategy == "normal":
+                no_prune_nodes = []
+                for cand_node in expand_nodes:
+                    cand_node_paths = k_hop_input_graph.nodes[cand_node]["call_paths"]
+                    if (cand_node_paths & target_node_paths) or k_hop_input_graph.nodes[cand_node]["exception"] == True:
+                        no_prune_nodes.append(cand_node)
+                """如果有可以剪枝的点"""
+                if len(no_prune_nodes) != len(expand_nodes):
+                    expand_nodes = [element for element in expand_nodes if element not in no_prune_nodes]
+
+            children = tree.children[current_node_id]
+            children_keys = {tree.coalitions[child] for child in children}
+            cur_graph_key = tree.coalitions[current_node_id]
+            for each_node in expand_nodes:
+                # for each node, pruning it and get the remaining sub-graph
+                new_graph_key = cur_graph_key & ~(1 << tree.node_pos[each_node])
+                # check the state map and merge the same sub-graph
+                new_node_id = tree.state_map.get(new_graph_key)
+                if new_node_id is None:  # one node less than the current node, so its counts drop by at most one
+                    removed_exception, removed_in_chain = node_prior_counts(k_hop_input_graph, each_node,
+                                                                            target_node_paths)
+                    new_node_id = tree.add_node(new_graph_key,
+                                                int(tree.exception_count[current_node_id]) - removed_exception,
+                                                int(tree.chain_count[current_node_id]) - removed_in_chain)
+
+                if new_graph_key not in children_keys:
+                    children_keys.add(new_graph_key)
+                    children.append(new_node_id)
+
+            # score every child not seen before with one gnn forward and one knn pass
+            new_children = [child for child in children if tree.coalitions[child] not in subgraph_embedding_dict]
+            if new_children:
+                scores, subgraph_embs = subgraph_score(k_neighbors, node_embedding_index, all_node_labels,
+                                                       target_node, target_node_label,
+                                                       [tree.coalition_nodes(child) for child in new_children],
+                                                       k_hop_input_graph,
+                                                       gnnNet)
+                for child, score, subgraph_emb in zip(new_children, scores, subgraph_embs):
+                    tree.R[child] = score
+                    subgraph_embedding_dict[tree.coalitions[child]] = subgraph_emb
+
+        children = tree.children[current_node_id]
+        sum_count = int(tree.C[children].sum())
+        """pruning strategy: Q + U/ Q + U + E + CC"""
+        if mcts_pruning_strategy == "soft_pruning" or mcts_pruning_strategy == "normal" or \
+                mcts_pruning_strategy == "original":
+            # selection scores of all children as one array op, E and CC are cached priors
+            if mcts_pruning_strategy == "soft_pruning":
+                selection_scores = tree.Q(children) + tree.U(children, sum_count) + tree.E(children) + tree.CC(
+                    children)
+            else:
+                selection_scores = tree.Q(children) + tree.U(children, sum_count)
+            max_value = selection_scores.max()
+            next_node_candidates = [child for child, score in zip(children, selection_scores) if score == max_value]
+            selected_node_id = random.choice(next_node_candidates)
+        elif mcts_pruning_strategy == "random":
+            selected_node_id = random.choice(children)
+        else:
+            raise ValueError("not supportive mcts strategy.")
+        """Update value"""
+        decision_path_nodes.append(selected_node_id)
+        reward_list_in_decision_path.append(float(tree.R[selected_node_id]))
+        removed_key = tree.coalitions[current_node_id] ^ tree.coalitions[selected_node_id]
+        coalition_degrees.remove(removed_key.bit_length() - 1)
+        current_node_id = selected_node_id
+
+
+def rescore_tree(k_neighbors, node_embedding_index, all_node_labels, tree, target_node, target_node_label,
+                 k_hop_input_graph, gnnNet, batch_size=256, end_time=math.inf):
+    """
+    score the decision path nodes of a tree from an earlier mcts call again with the current model, the other
+    nodes are scored when a rollout expands their parent. Returns the new subgraph embeddings by coalition, or None
+    if end_time (a time.time() value) is reached before every batch is scored
+    """
+    subgraph_embedding_dict = {}
+    path_node_ids = sorted(tree.path_nodes.values())
+    for start in range(0, len(path_node_ids), batch_size):
+        if time.time() >= end_time:
+            return None
+        node_ids = path_node_ids[start:start + batch_size]
+        scores, subgraph_embs = subgraph_score(k_neighbors, node_embedding_index, all_node_labels,
+                                               target_node, target_node_label,
+                                               [tree.coalition_nodes(node_id) for node_id in node_ids],
+                                               k_hop_input_graph,
+                                               gnnNet)
+        for node_id, score, subgraph_emb in zip(node_ids, scores, subgraph_embs):
+            tree.R[node_id] = score
+            subgraph_embedding_dict[tree.coalitions[node_id]] = subgraph_emb
+    return subgraph_embedding_dict
+
+
+def mcts_single_subgraph_in_parallel(k_neighbors, node_embedding_index, all_node_labels,
                                      mcts_stop_strategy, mcts_pruning_strategy, rollout_num,
                                      min_atoms, gnnNet,
-                                     target_node, target_node_label, k_hop_graph):
+                                     target_node, target_node_label, k_hop_graph, tree=None, patience=None,
+                                     time_budget=None, deadline=None, rollout_counter=None, reuse_rollout_num=0):
+    """
+    search one k-hop graph, returns its prototype candidates, the search tree pruned to its decision paths and
+    (rollouts run, stop reason). A tree from an earlier call is not searched again: its path nodes are re-scored
+    with the current model and give the candidates, after only reuse_rollout_num rollouts instead of rollout_num
+    (kept nodes lost their children in pruning, so these rollouts expand and score them afresh).
+    The search stops before its rollouts are done once the topk candidates have not changed for patience rollouts
+    ("converged"), or when it runs out of budget ("budget"): time_budget seconds for this graph, the deadline
+    (a time.time() value) of the whole mcts call, or the rollouts left in the shared rollout_counter
+    """
+    end_time = deadline if deadline is not None else math.inf
+    if time_budget is not None:
+        end_time = min(end_time, time.time() + time_budget)
+    if time.time() >= end_time:  # nothing left for this graph, not even re-scoring its tree
+        return [], tree, (0, "budget")
     """将无向图还原成有向图"""
     # undirected_graph, directed_edges = k_hop_graph
     #
@@ -190,89 +329,238 @@ def mcts_single_subgraph_in_parallel(k_neighbors, all_node_embeddings, all_node_
     #     directed_graph.nodes[target].update(undirected_graph.nodes[target])
     #     directed_graph.edges[(source, target)].update(undirected_graph.edges[(source, target)])
     # k_hop_graph = directed_graph
-
-    root_coalition = sorted(list(k_hop_graph.nodes()))
-    root = MCTSNode(root_coalition, ori_graph=k_hop_graph)
-    state_map = {}
-    subgraph_embedding_dict = {}
-    all_path_subgraph_dict = {}  # subgraph in decision paths
+    if isinstance(k_hop_graph, KHopSubgraph):  # the networkx view is built here, in the worker
+        k_hop_graph = k_hop_graph.to_networkx()
+
+    if tree is None:
+        tree = MCTSTree(sorted(list(k_hop_graph.nodes())))
+        root_exception_count, root_chain_count = coalition_prior_counts(k_hop_graph, tree.node_names, target_node)
+        tree.add_node((1 << len(tree.node_names)) - 1, root_exception_count, root_chain_count)
+        subgraph_embedding_dict = {}
+    else:
+        subgraph_embedding_dict = rescore_tree(k_neighbors, node_embedding_index, all_node_labels, tree,
+                                               target_node, target_node_label, k_hop_graph, gnnNet,
+                                               end_time=end_time)
+        if subgraph_embedding_dict is None:  # out of budget while re-scoring, the tree goes on next call
+            return [], tree, (0, "budget")
+        rollout_num = reuse_rollout_num
+    root = 0
+    root_degrees = CoalitionDegrees.of_graph(k_hop_graph, tree.node_pos)
+    all_path_subgraph_dict = tree.path_nodes  # subgraph in decision paths
+    topk = 10
+    rollouts_run, stop_reason = 0, "done"
+    top_subgraphs, stable_rollouts = None, 0
     for i in range(rollout_num):
+        if time.time() >= end_time or not take_rollout(rollout_counter):
+            stop_reason = "budget"
+            break
         decision_path_nodes = []
         reward_list_in_decision_path = []
-        mcts_rollout(k_neighbors, all_node_embeddings, all_node_labels, mcts_stop_strategy,
+        mcts_rollout(k_neighbors, node_embedding_index, all_node_labels, mcts_stop_strategy,
                      reward_list_in_decision_path, mcts_pruning_strategy,
-                     root,
-                     state_map, subgraph_embedding_dict, k_hop_graph,
+                     tree, root, root_degrees.copy(),
+                     subgraph_embedding_dict, k_hop_graph,
                      min_atoms, target_node, target_node_label,
                      gnnNet, decision_path_nodes)
 
         """Update path node value"""
-        for path_subgraph in decision_path_nodes:
-            all_path_subgraph_dict[str(path_subgraph.coalition)] = path_subgraph
+        for node_id in decision_path_nodes:
+            all_path_subgraph_dict[tree.coalitions[node_id]] = node_id
 
-        average_reward = sum(node.R for node in decision_path_nodes) / len(decision_path_nodes) if len(
+        average_reward = sum(tree.R[decision_path_nodes].tolist()) / len(decision_path_nodes) if len(
             decision_path_nodes) != 0 else 0.0
-        for node in decision_path_nodes:
-            node.W += average_reward
-            node.C += 1
+        for node_id in decision_path_nodes:
+            tree.W[node_id] += average_reward
+            tree.C[node_id] += 1
+        rollouts_run += 1
+
+        if patience is not None:
+            new_top_subgraphs = top_path_subgraphs(tree, topk)
+            stable_rollouts = stable_rollouts + 1 if new_top_subgraphs == top_subgraphs else 0
+            top_subgraphs = new_top_subgraphs
+            if stable_rollouts >= patience:
+                stop_reason = "converged"
+                break
 
-    all_subgraphs = [node for _, node in all_path_subgraph_dict.items()]
+    all_subgraphs = list(all_path_subgraph_dict.values())
     if mcts_pruning_strategy == "random":
         random.shuffle(all_subgraphs)
     else:
-        all_subgraphs = sorted(all_subgraphs, key=lambda x: x.R, reverse=True)
+        all_subgraphs = sorted(all_subgraphs, key=lambda node_id: tree.R[node_id], reverse=True)
 
     res = []
-    topk = 10
     for selected in all_subgraphs:
+        selected_R = float(tree.R[selected])
         if mcts_pruning_strategy == "random":
             if len(res) < topk:
-                candidate_prototype = subgraph_embedding_dict[str(selected.coalition)]
-                res.append((target_node_label, candidate_prototype.detach(), selected.R))
+                candidate_prototype = subgraph_embedding_dict[tree.coalitions[selected]]
+                res.append((target_node_label, candidate_prototype.detach(), selected_R))
         else:
-            if selected.R > 0 and len(res) < topk:
-                candidate_prototype = subgraph_embedding_dict[str(selected.coalition)]
-                res.append((target_node_label, candidate_prototype.detach(), selected.R))
-    return res
-
-
-def select_prototypes_with_most_distance_each_other(bound, num_prototype, all_cand_prototype_list):
+            if selected_R > 0 and len(res) < topk:
+                candidate_prototype = subgraph_embedding_dict[tree.coalitions[selected]]
+                res.append((target_node_label, candidate_prototype.detach(), selected_R))
+    return res, tree.pruned(), (rollouts_run, stop_reason)
+
+
+def top_path_subgraphs(tree, topk):
+    """ids of the topk decision path nodes with greatest positive R, i.e. the nodes that would become candidates"""
+    path_node_ids = sorted(tree.path_nodes.values(), key=lambda node_id: tree.R[node_id], reverse=True)
+    return frozenset(node_id for node_id in path_node_ids[:topk] if tree.R[node_id] > 0)
+
+
+def take_rollout(rollout_counter):
+    """take one rollout from the rollouts left to the whole mcts call, False once none are left"""
+    if rollout_counter is None:
+        return True
+    with rollout_counter.get_lock():
+        if rollout_counter.value <= 0:
+            return False
+        rollout_counter.value -= 1
+        return True
+
+
+_mcts_worker_args = None  # search settings, shared tensors and k-hop graphs of the current mcts call
+_mcts_worker_ready_barrier = None  # met by every worker once, to time the pool startup
+
+
+def _init_mcts_worker(k_neighbors, node_embedding_index, all_node_labels, mcts_stop_strategy, mcts_pruning_strategy,
+                      rollout_num, reuse_rollout_num, min_atoms, gnnNet, task_graphs, patience, subgraph_time_budget,
+                      deadline, rollout_counter, ready_barrier):
+    """runs once per worker: shared-memory tensors arrive as handles, k-hop graphs are unpickled once"""
+    global _mcts_worker_args, _mcts_worker_ready_barrier
+    _mcts_worker_ready_barrier = ready_barrier
+    _mcts_worker_args = (k_neighbors, node_embedding_index, all_node_labels, mcts_stop_strategy,
+                         mcts_pruning_strategy, rollout_num, reuse_rollout_num, min_atoms, gnnNet, task_graphs,
+                         patience, subgraph_time_budget, deadline, rollout_counter)
+
+
+def _mcts_task(graph_id, target_node, tree):
+    (k_neighbors, node_embedding_index, all_node_labels, mcts_stop_strategy, mcts_pruning_strategy, rollout_num,
+     reuse_rollout_num, min_atoms, gnnNet, task_graphs, patience, subgraph_time_budget, deadline,
+     rollout_counter) = _mcts_worker_args
+    target_node_label, k_hop_graph = task_graphs[graph_id]
+    deadline = deadline.value if deadline is not None else None  # set by the parent once the pool has started
+    return mcts_single_subgraph_in_parallel(k_neighbors, node_embedding_index, all_node_labels, mcts_stop_strategy,
+                                            mcts_pruning_strategy, rollout_num, min_atoms, gnnNet, target_node,
+                                            target_node_label, k_hop_graph, tree, patience, subgraph_time_budget,
+                                            deadline, rollout_counter, reuse_rollout_num)
+
+
+def _mcts_worker_ready():
+    """blocks until every worker has run its initializer, so one of these lands on each worker"""
+    _mcts_worker_ready_barrier.wait()
+    return os.getpid()
+
+
+def _mcts_chunk(tasks):
+    start_time = time.time()
+    results = [_mcts_task(graph_id, target_node, tree) for graph_id, target_node, tree in tasks]
+    return results, os.getpid(), time.time() - start_time
+
+
+def schedule_mcts_chunks(task_costs, num_workers, chunks_per_worker=4):
+    """
+    group task indices into chunks of about total cost / (num_workers * chunks_per_worker). Tasks are taken
+    largest first, so costly subgraphs start early and get a chunk of their own while small ones share one
+    """
+    order = sorted(range(len(task_costs)), key=lambda i: task_costs[i], reverse=True)
+    target_cost = sum(task_costs) / max(1, num_workers * chunks_per_worker)
+    chunks = []
+    chunk = []
+    chunk_cost = 0
+    for i in order:
+        chunk.append(i)
+        chunk_cost += task_costs[i]
+        if chunk_cost >= target_cost:
+            chunks.append(chunk)
+            chunk = []
+            chunk_cost = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def report_worker_utilisation(chunk_stats, wall_time):
+    """busy share of the pool wall time per worker process, from (pid, task num, busy seconds) of every chunk"""
+    worker_stats = {}
+    for worker_pid, task_num, busy_time in chunk_stats:
+        chunk_num, worker_task_num, worker_busy_time = worker_stats.get(worker_pid, (0, 0, 0.0))
+        worker_stats[worker_pid] = (chunk_num + 1, worker_task_num + task_num, worker_busy_time + busy_time)
+    print(f"mcts pool: {len(chunk_stats)} chunks on {len(worker_stats)} workers in {wall_time:.2f}s")
+    for worker_pid, (chunk_num, task_num, busy_time) in sorted(worker_stats.items()):
+        print(f"mcts worker {worker_pid}: {chunk_num} chunks, {task_num} tasks, busy {busy_time:.2f}s "
+              f"({100 * busy_time / wall_time if wall_time > 0 else 0.0:.1f}%)")
+
+
+def greedy_diverse_prototypes(distances, num_prototype, dis_threshold):
+    """
+    indices kept by one greedy pass in candidate order: a candidate is kept if it is at least dis_threshold
+    away from every kept one. Each step masks out everything too close to the newly kept candidate
+    """
+    alive = torch.ones(distances.size(0), dtype=torch.bool, device=distances.device)
+    picked = []
+    while len(picked) < num_prototype and alive.any():
+        idx = int(torch.argmax(alive.to(torch.uint8)))  # first candidate still far enough from all kept ones
+        picked.append(idx)
+        alive &= distances[idx] >= dis_threshold
+        alive[idx] = False
+    return picked
+
+
+def report_saved_rollouts(rollout_stats, planned):
+    """rollouts run against the planned ones of all graphs, and why searches stopped early"""
+    rollouts_run = sum(task_rollouts for task_rollouts, _ in rollout_stats)
+    converged = sum(stop_reason == "converged" for _, stop_reason in rollout_stats)
+    out_of_budget = sum(stop_reason == "budget" for _, stop_reason in rollout_stats)
+    print(f"mcts rollouts: {rollouts_run}/{planned} run, {planned - rollouts_run} saved; "
+          f"searches stopped early: {converged} converged, {out_of_budget} out of budget")
+
+
+def select_prototypes_with_most_distance_each_other(bound, num_prototype, all_cand_prototype_list, n_iter=30):
+    """
+    num_prototype candidates among the top bound ones that are far from each other, preferring earlier (higher R)
+    candidates: binary search for the largest distance threshold under which the greedy pass still keeps
+    num_prototype candidates
+    """
     if bound > len(all_cand_prototype_list):  # in case of out of bound
         bound = len(all_cand_prototype_list)
-    top_bound_prots = all_cand_prototype_list[:bound]
-    tensor_matrix = torch.stack(top_bound_prots)
-
-    distances = torch.norm(tensor_matrix.unsqueeze(0) - tensor_matrix.unsqueeze(1), dim=2)
-    dis_threshold = torch.max(distances).item()
-    print("max distance over selected prots:", dis_threshold)
-    candidates = []
-    need_loop = True
-    while need_loop:
-        for i in range(bound):
-            if not candidates:
-                candidates.append((top_bound_prots[i], i))
-            else:
-                ok = True
-                for cand, idx in candidates:
-                    if distances[i][idx].item() < dis_threshold:
-                        ok = False
-                        break
-                if ok:
-                    candidates.append((top_bound_prots[i], i))
-            if i == bound - 1 and len(candidates) != num_prototype:
-                dis_threshold = dis_threshold * 0.99
-                candidates.clear()
-            if len(candidates) == num_prototype:
-                need_loop = False
-                break
-    candidates = [candidate for candidate, _ in candidates]
-    print("min distance over final prots:", dis_threshold)
-    return torch.stack(candidates)
+    if bound < num_prototype:
+        raise ValueError("not enough prototype candidates.")
+    tensor_matrix = torch.stack(all_cand_prototype_list[:bound])
+
+    distances = torch.cdist(tensor_matrix, tensor_matrix, compute_mode="donot_use_mm_for_euclid_dist")
+    max_distance = torch.max(distances).item()
+    print("max distance over selected prots:", max_distance)
+    low, high = 0.0, max_distance
+    picked = greedy_diverse_prototypes(distances, num_prototype, low)  # a zero threshold keeps every candidate
+    for _ in range(n_iter):
+        dis_threshold = (low + high) / 2
+        cand_picked = greedy_diverse_prototypes(distances, num_prototype, dis_threshold)
+        if len(cand_picked) == num_prototype:
+            low, picked = dis_threshold, cand_picked
+        else:
+            high = dis_threshold
+    picked = torch.tensor(picked, device=distances.device)
+    min_distance = distances[picked][:, picked].fill_diagonal_(float("inf")).min().item() if num_prototype > 1 else 0.0
+    print("min distance over final prots:", min_distance)
+    return tensor_matrix[picked]
 
 
 def mcts(dataset, train_prot_dataloader, rollout_num, min_atoms, k_hop_graphs, gnnNet, prototype_num_each_class,
          random_negative_sample, device, mcts_pruning_strategy,
-         mcts_stop_strategy, k_neighbors, mcts_top_bound, mcts_prot_selection):
+         mcts_stop_strategy, k_neighbors, mcts_top_bound, mcts_prot_selection, mcts_knn_index="exact",
+         mcts_workers=None, mcts_chunks_per_worker=4, mcts_trees=None, mcts_reuse_rollout_num=0, mcts_patience=None,
+         mcts_time_budget=None, mcts_subgraph_time_budget=None, mcts_rollout_budget=None):
+    """
+    mcts_trees: dict of search trees by graph id, filled by this call and reused by the next one with the same
+    dict. Later calls re-score the cached decision path nodes with the current model instead of searching again,
+    running mcts_reuse_rollout_num rollouts per reused tree rather than rollout_num. Only decision path nodes are
+    kept, which keeps the trees small to store and to pickle to and from the workers.
+    mcts_patience: a search stops once its topk candidates have not changed for this many rollouts.
+    mcts_time_budget / mcts_rollout_budget: seconds / rollouts for all searches of this call, graphs reached after
+    that give no candidates. The seconds count from when every worker has started, the pool startup is only logged. mcts_subgraph_time_budget: seconds for the search of one graph.
+    Returns None if some class has fewer than prototype_num_each_class candidates
+    """
     all_node_embeddings = []
     all_node_labels = []
     for batch in train_prot_dataloader:
@@ -311,64 +599,83 @@ def mcts(dataset, train_prot_dataloader, rollout_num, min_atoms, k_hop_graphs, g
     else:
         random_k_hop_graphs = k_hop_graphs
 
-    task_parameters = [(k_neighbors, all_node_embeddings, all_node_labels, mcts_stop_strategy,
-                        mcts_pruning_strategy, rollout_num,
-                        min_atoms, gnnNet,
-                        target_node, target_node_label, k_hop_graph) for
-                       graph_id, target_node, target_node_label, k_hop_graph, k_hop_graph_data in
-                       random_k_hop_graphs if
-                       k_hop_graph.number_of_nodes() > min_atoms]
-
-    """parallel computing"""
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-
-        futures = [executor.submit(mcts_single_subgraph_in_parallel, *params) for params in task_parameters]
-        list(tqdm(concurrent.futures.as_completed(futures), total=len(task_parameters)))
-
-    prot_candidates_list = []
-    for future in futures:
-        prot_candidates_list.extend(future.result())
-
-    prot_candidates_dict = {}
-    for target_node_label, candidate_prototype, R in prot_candidates_list:
-        if target_node_label in prot_candidates_dict:
-            prot_cand_list = prot_candidates_dict[target_node_label]
-            prot_cand_list.append((candidate_prototype, R))  # 原型候选和其相似度
-            prot_candidates_dict[target_node_label] = prot_cand_list
+    node_embedding_index = build_neighbor_index(all_node_embeddings, mcts_knn_index).share_memory()
+    all_node_labels.share_memory_()
+    shared_gnn = copy.deepcopy(gnnNet).share_memory()  # workers read the weights, training keeps its own copy
+    task_graphs = {graph_id: (target_node_label, k_hop_graph) for
+                   graph_id, target_node, target_node_label, k_hop_graph, k_hop_graph_data in
+                   random_k_hop_graphs if
+                   k_hop_graph.number_of_nodes() > min_atoms}
+    cached_trees = mcts_trees if mcts_trees is not None else {}
+    task_parameters = [(graph_id, target_node, cached_trees.get(graph_id)) for
+                       graph_id, target_node, _, _, _ in random_k_hop_graphs if
+                       graph_id in task_graphs]  # a graph id, its target node and its tree from an earlier call
+
+    """parallel computing, chunks of similar estimated cost, largest first"""
+    mcts_workers = mcts_workers or os.cpu_count()
+    task_rollouts = [rollout_num if tree is None else mcts_reuse_rollout_num for _, _, tree in task_parameters]
+    task_costs = [task_graphs[graph_id][1].number_of_nodes() * task_rollout_num +
+                  (len(tree) if tree is not None else 0)  # re-scoring a reused tree
+                  for (graph_id, _, tree), task_rollout_num in zip(task_parameters, task_rollouts)]
+    chunks = schedule_mcts_chunks(task_costs, mcts_workers, mcts_chunks_per_worker)
+    candidate_pool = PrototypeCandidatePool(mcts_top_bound, sample=mcts_pruning_strategy == "random")
+    chunk_stats = []
+    rollout_stats = []
+    start_time = time.time()
+    deadline = multiprocessing.Value("d", math.inf) if mcts_time_budget is not None else None
+    rollout_counter = multiprocessing.Value("q", mcts_rollout_budget) if mcts_rollout_budget is not None else None
+    ready_barrier = multiprocessing.Barrier(mcts_workers)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=mcts_workers, initializer=_init_mcts_worker,
+                                                initargs=(k_neighbors, node_embedding_index, all_node_labels,
+                                                          mcts_stop_strategy, mcts_pruning_strategy, rollout_num,
+                                                          mcts_reuse_rollout_num, min_atoms, shared_gnn, task_graphs,
+                                                          mcts_patience, mcts_subgraph_time_budget, deadline,
+                                                          rollout_counter, ready_barrier)) as executor:
+        # spawning the workers and unpickling the graphs, model and index in them does not count against the budget
+        concurrent.futures.wait([executor.submit(_mcts_worker_ready) for _ in range(mcts_workers)])
+        startup_time = time.time() - start_time
+        if deadline is not None:
+            deadline.value = time.time() + mcts_time_budget
+            print(f"mcts pool startup: {startup_time:.2f}s on {mcts_workers} workers, "
+                  f"the {mcts_time_budget:.2f}s time budget starts after it")
         else:
-            prot_candidates_dict[target_node_label] = [(candidate_prototype, R)]
+            print(f"mcts pool startup: {startup_time:.2f}s on {mcts_workers} workers")
+        futures = {executor.submit(_mcts_chunk, [task_parameters[i] for i in chunk]): chunk for chunk in chunks}
+        with tqdm(total=len(task_parameters)) as pbar:
+            for future in concurrent.futures.as_completed(futures):
+                chunk_results, worker_pid, busy_time = future.result()
+                for i, (res, tree, task_rollout_stats) in zip(futures[future], chunk_results):
+                    candidate_pool.add(i, res)  # only the bound best candidates of every class stay
+                    rollout_stats.append(task_rollout_stats)
+                    if mcts_trees is not None and tree is not None:
+                        mcts_trees[task_parameters[i][0]] = tree
+                chunk_stats.append((worker_pid, len(chunk_results), busy_time))
+                pbar.update(len(chunk_results))
+    report_worker_utilisation(chunk_stats, time.time() - start_time)
+    report_saved_rollouts(rollout_stats, sum(task_rollouts))
+    if mcts_trees is not None:
+        print(f"mcts trees reused: {sum(tree is not None for _, _, tree in task_parameters)}/{len(task_parameters)}")
+
+    prot_candidates_dict = candidate_pool.candidates()  # 原型候选和其相似度
+    target_node_labels = {target_node_label for _, _, target_node_label, _, _ in k_hop_graphs}
+    short_labels = [target_node_label for target_node_label in sorted(target_node_labels) if
+                    len(prot_candidates_dict.get(target_node_label, [])) < prototype_num_each_class]
+    if short_labels:  # searches out of budget or without positive rewards, a class would get too few prototypes
+        print(f"not enough prototype candidates of classes {short_labels}, "
+              f"{prototype_num_each_class} needed for every class")
+        return None
 
     new_prots_list = []
     if mcts_prot_selection == "kmeans" and mcts_pruning_strategy != "random":
-        for prototype_class, cand_prot_list in prot_candidates_dict.items():
-            cand_prot_list = sorted(cand_prot_list, key=lambda x: x[1], reverse=True)
-            cand_prots = [(prot.tolist(), R) for prot, R in cand_prot_list]
-            unique_cand_prots = []
-            for prot, R in cand_prots:
-                unique = True
-                for u, r in unique_cand_prots:
-                    if prot == u:
-                        unique = False
-                        break
-                if unique:
-                    unique_cand_prots.append((prot, R))
+        for prototype_class, unique_cand_prots in prot_candidates_dict.items():
             """select prototype with greatest R value in every clusters by kmeans"""
-            new_prototypes = select_m_prototypes_by_kmeans(unique_cand_prots[:mcts_top_bound],
+            new_prototypes = select_m_prototypes_by_kmeans(torch.stack([prot for prot, _ in unique_cand_prots]),
+                                                           torch.tensor([R for _, R in unique_cand_prots]),
                                                            num_clusters=prototype_num_each_class)
             new_prots_list.append((prototype_class, new_prototypes))
     elif mcts_prot_selection == "topk" and mcts_pruning_strategy != "random":
         for prototype_class, cand_prot_list in prot_candidates_dict.items():
-            cand_prot_list = sorted(cand_prot_list, key=lambda x: x[1], reverse=True)
-            cand_prots = [prot for prot, _ in cand_prot_list]
-            unique_cand_prots = []
-            for prot in cand_prots:
-                unique = True
-                for u in unique_cand_prots:
-                    if torch.equal(u, prot):
-                        unique = False
-                        break
-                if unique:
-                    unique_cand_prots.append(prot)
+            unique_cand_prots = [prot for prot, _ in cand_prot_list]
 
             new_prototypes = select_prototypes_with_most_distance_each_other(mcts_top_bound, prototype_num_each_class,
                                                                              unique_cand_prots)
@@ -386,71 +693,295 @@ def mcts(dataset, train_prot_dataloader, rollout_num, min_atoms, k_hop_graphs, g
     return new_prototype_layer.detach()
 
 
-def select_m_prototypes_by_kmeans(data, num_clusters):
-    data_array = np.array([(np.array(x), r) for x, r in data], dtype=object)
+def prototype_key(candidate_prototype):
+    """hashable key of a prototype candidate, equal for equal embeddings whichever device they are on"""
+    return candidate_prototype.detach().cpu().numpy().tobytes()
 
-    X = np.array([x for x, r in data_array])
 
-    kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init='auto')
-    cluster_assignments = kmeans.fit_predict(X)
-
-    res = []
-    for i in range(num_clusters):
-        cluster_data = data_array[cluster_assignments == i]
-        max_R_index = np.argmax(cluster_data[:, 1])
-        max_R_data = cluster_data[max_R_index]
-        res.append(list(max_R_data[0]))
-    return torch.Tensor(res).to('cuda') if torch.cuda.is_available() else torch.Tensor(res).to('cpu')
+class PrototypeCandidatePool:
+    """
+    prototype candidates of every class, added task by task as results come in and bounded per class. Kept are the
+    bound unique prototypes with greatest R (earlier tasks first on equal R, as if all candidates were sorted in task
+    order), or with sample=True a uniform sample of bound candidates for the random strategy
+    """
 
+    def __init__(self, bound, sample=False):
+        self.bound = bound
+        self.sample = sample
+        self.heaps = {}  # class -> min-heap of (R, -task index, -rank in task, prototype key)
+        self.entries = {}  # class -> {prototype key: (heap key, prototype)}
+        self.samples = {}  # class -> reservoir of (prototype, R)
+        self.seen = {}  # class -> number of candidates offered to the reservoir
 
-def subgraph_score(k_neighbors, all_node_embeddings, all_node_labels,
+    def add(self, task_index, res):
+        for rank, (target_node_label, candidate_prototype, R) in enumerate(res):
+            if self.sample:
+                self._add_sample(target_node_label, candidate_prototype, R)
+            else:
+                self._add_best(target_node_label, (R, -task_index, -rank, prototype_key(candidate_prototype)),
+                               candidate_prototype)
+
+    def _add_best(self, target_node_label, heap_key, candidate_prototype):
+        heap = self.heaps.setdefault(target_node_label, [])
+        entries = self.entries.setdefault(target_node_label, {})
+        prototype_key = heap_key[-1]
+        if prototype_key in entries:  # a repeated prototype keeps its better candidate
+            if entries[prototype_key][0] >= heap_key:
+                return
+            heap.remove(entries[prototype_key][0])
+            heapq.heapify(heap)
+        elif len(heap) >= self.bound:
+            if heap[0] >= heap_key:
+                return
+            del entries[heapq.heappop(heap)[-1]]
+        heapq.heappush(heap, heap_key)
+        entries[prototype_key] = (heap_key, candidate_prototype)
+
+    def _add_sample(self, target_node_label, candidate_prototype, R):
+        reservoir = self.samples.setdefault(target_node_label, [])
+        self.seen[target_node_label] = self.seen.get(target_node_label, 0) + 1
+        if len(reservoir) < self.bound:
+            reservoir.append((candidate_prototype, R))
+        else:
+            idx = random.randrange(self.seen[target_node_label])
+            if idx < self.bound:
+                reservoir[idx] = (candidate_prototype, R)
+
+    def candidates(self):
+        """class -> list of (prototype, R), greatest R first unless sampled"""
+        if self.sample:
+            return {target_node_label: list(reservoir) for target_node_label, reservoir in self.samples.items()}
+        return {target_node_label: [(candidate_prototype, heap_key[0]) for heap_key, candidate_prototype in
+                                    sorted(entries.values(), key=lambda x: x[0], reverse=True)]
+                for target_node_label, entries in self.entries.items()}
+
+
+def kmeans_plus_plus(X, num_clusters, generator):
+    """
+    greedy k-means++ seeding: for every next centroid a few rows are drawn with probability proportional to their
+    squared distance to the nearest centroid so far, and the one leaving the smallest total distance is kept
+    """
+    n_trials = 2 + int(math.log(num_clusters))
+    first_row = int(torch.randint(X.size(0), (1,), generator=generator, device=X.device))
+    centroids = [X[first_row]]
+    min_distances = torch.cdist(X, X[first_row].unsqueeze(0), compute_mode="donot_use_mm_for_euclid_dist").squeeze(1) ** 2
+    for _ in range(1, num_clusters):
+        if min_distances.sum() > 0:
+            trial_rows = torch.multinomial(min_distances, n_trials, replacement=True, generator=generator)
+        else:  # only repeated rows left
+            trial_rows = torch.randint(X.size(0), (n_trials,), generator=generator, device=X.device)
+        trial_distances = torch.minimum(min_distances.unsqueeze(0), torch.cdist(
+            X[trial_rows], X, compute_mode="donot_use_mm_for_euclid_dist") ** 2)
+        best_trial = int(torch.argmin(trial_distances.sum(dim=1)))
+        centroids.append(X[trial_rows[best_trial]])
+        min_distances = trial_distances[best_trial]
+    return torch.stack(centroids)
+
+
+def mini_batch_kmeans(X, num_clusters, batch_size=1024, n_iter=100, seed=42):
+    """
+    k-means++ seeding, then every step assigns a random batch of rows and moves each centroid to the running mean of
+    all rows assigned to it so far. Up to batch_size rows every step is a full lloyd step instead. Returns the
+    centroids and the cluster of every row
+    """
+    generator = torch.Generator(device=X.device).manual_seed(seed)
+    centroids = kmeans_plus_plus(X, num_clusters, generator)
+    counts = torch.zeros(num_clusters, dtype=X.dtype, device=X.device)
+    for _ in range(n_iter):
+        if X.size(0) <= batch_size:
+            batch, counts = X, torch.zeros_like(counts)
+        else:
+            batch = X[torch.randint(X.size(0), (batch_size,), generator=generator, device=X.device)]
+        assignment = torch.cdist(batch, centroids).argmin(dim=1)
+        batch_counts = torch.bincount(assignment, minlength=num_clusters).to(X.dtype)
+        batch_sums = torch.zeros_like(centroids).index_add_(0, assignment, batch)
+        new_counts = counts + batch_counts
+        non_empty = batch_counts > 0
+        new_centroids = centroids.clone()
+        new_centroids[non_empty] = (centroids[non_empty] * counts[non_empty].unsqueeze(1) + batch_sums[non_empty]) / \
+            new_counts[non_empty].unsqueeze(1)
+        converged = torch.equal(new_centroids, centroids)
+        centroids, counts = new_centroids, new_counts
+        if converged:
+            break
+    return centroids, torch.cdist(X, centroids).argmin(dim=1)
+
+
+def select_m_prototypes_by_kmeans(prototypes, rewards, num_clusters):
+    """
+    the greatest-R candidate of every mini-batch k-means cluster, found with a scatter-max over R; clusters left
+    empty are made up with the greatest-R candidates not taken yet
+    """
+    num_rows = prototypes.size(0)
+    if num_rows < num_clusters:
+        raise ValueError("not enough prototype candidates.")
+    rewards = rewards.to(prototypes.device)
+    _, assignment = mini_batch_kmeans(prototypes, num_clusters)
+    max_rewards = torch.full((num_clusters,), -math.inf, dtype=rewards.dtype, device=rewards.device).scatter_reduce(
+        0, assignment, rewards, reduce="amax")
+    positions = torch.arange(num_rows, device=prototypes.device)
+    max_positions = torch.where(rewards == max_rewards[assignment], positions, num_rows)
+    selected = torch.full((num_clusters,), num_rows, dtype=torch.long, device=prototypes.device).scatter_reduce(
+        0, assignment, max_positions, reduce="amin")
+    selected = selected[selected < num_rows]
+    if selected.numel() < num_clusters:
+        taken = torch.zeros(num_rows, dtype=torch.bool, device=prototypes.device)
+        taken[selected] = True
+        rest = positions[~taken]
+        rest = rest[torch.argsort(rewards[rest], descending=True, stable=True)]
+        selected = torch.cat([selected, rest[:num_clusters - selected.numel()]])
+    return prototypes[selected]
+
+
+def subgraph_score(k_neighbors, node_embedding_index, all_node_labels,
                    target_node, target_node_label,
-                   coalition, k_hop_input_graph, gnnNet):
-    subgraph_emb = subgraph_embedding(target_node, coalition, k_hop_input_graph, gnnNet)
-    avg_similarity_score = graph_emb_and_node_embs_similarity(k_neighbors, all_node_embeddings,
-                                                              all_node_labels,
-                                                              target_node_label, subgraph_emb)
-    return avg_similarity_score, subgraph_emb
-
-
-def subgraph_embedding(target_node, coalition, k_hop_input_graph, gnnNet):
-    subG = k_hop_input_graph.subgraph(coalition)
-
-    subG_features = [k_hop_input_graph.nodes[node]['feature'] for node in subG.nodes]
-
-    subG_features = torch.tensor(subG_features, dtype=torch.float32)
-
-    subG_edges = [[list(subG.nodes).index(u), list(subG.nodes).index(v)] for u, v in subG.edges]
-    subG_edge_index = np.transpose(subG_edges).tolist()
-
-    data = Data(x=subG_features, edge_index=torch.tensor(subG_edge_index).long())
+                   coalitions, k_hop_input_graph, gnnNet):
+    """rewards and target node embeddings of a list of coalitions"""
+    subgraph_embs = subgraph_embedding(target_node, coalitions, k_hop_input_graph, gnnNet)
+    avg_similarity_scores = graph_emb_and_node_embs_similarity(k_neighbors, node_embedding_index,
+                                                               all_node_labels,
+                                                               target_node_label, subgraph_embs)
+    return avg_similarity_scores, subgraph_embs
+
+
+def subgraph_embedding(target_node, coalitions, k_hop_input_graph, gnnNet):
+    """target node embedding in each coalition's subgraph, all subgraphs go through gnnNet as one batch"""
+    data_list = []
+    target_node_idx = []
+    for coalition in coalitions:
+        subG_features, subG_edge_index, node_idx = nx_to_pyg(k_hop_input_graph.subgraph(coalition))
+        data_list.append(Data(x=subG_features, edge_index=subG_edge_index))
+        target_node_idx.append(node_idx[target_node])
+    data = Batch.from_data_list(data_list)
     if torch.cuda.is_available():
         data = data.to('cuda')
-    data = Batch.from_data_list([data])
 
-    target_node_idx = list(subG.nodes).index(target_node)
+    target_node_idx = data.ptr[:-1] + torch.tensor(target_node_idx, device=data.ptr.device)
     with torch.no_grad():
-        target_node_embedding = gnnNet(data)[target_node_idx]
-    return target_node_embedding
+        target_node_embeddings = gnnNet(data)[target_node_idx]
+    return target_node_embeddings
 
 
-def graph_emb_and_node_embs_similarity(k_neighbors, all_node_embeddings, all_node_labels, target_node_label,
-                                       subgraph_emb):
-    """ the average similarity value of subgraph and k nearest node embeddings"""
-    score = knn(all_node_embeddings, all_node_labels, subgraph_emb, target_node_label, k_neighbors)
+def graph_emb_and_node_embs_similarity(k_neighbors, node_embedding_index, all_node_labels, target_node_label,
+                                       subgraph_embs):
+    """ the average similarity value of each subgraph and its k nearest node embeddings"""
+    scores = knn(node_embedding_index, all_node_labels, subgraph_embs, target_node_label, k_neighbors)
     # return score if score > 0 else 0.0
-    return score
+    return scores
 
 
-def knn(all_node_embeddings, all_node_labels, subg_embedding, target_node_label, topk):
-    distances = torch.norm(all_node_embeddings - subg_embedding, dim=1) ** 2
+def knn(node_embedding_index, all_node_labels, subg_embeddings, target_node_label, topk):
+    """knn reward of every row of subg_embeddings, neighbours come from one batched index query"""
+    distances, top_k_indices = node_embedding_index.search(subg_embeddings, topk)
     epsilon = 1e-4
-    similarity_list = torch.log((distances + 1) / (distances + epsilon))
-
-    top_k_indices = torch.topk(similarity_list, k=topk, largest=True).indices
+    top_k_similarity = torch.log((distances + 1) / (distances + epsilon))
 
     labels_top_k = all_node_labels[top_k_indices]
 
     weighted_distances = torch.sum(
-        similarity_list[top_k_indices] * (2 * (labels_top_k == target_node_label).float() - 1)) / topk
-    return weighted_distances.item()
+        top_k_similarity * (2 * (labels_top_k == target_node_label).float() - 1), dim=1) / topk
+    return weighted_distances.tolist()
+
+
+class ExactNeighborIndex:
+    """exact k nearest embeddings, queries meet the embeddings block by block so memory stays queries x block_size"""
+
+    def __init__(self, embeddings, block_size=65536):
+        self.embeddings = embeddings
+        self.block_size = block_size
+
+    def share_memory(self):
+        self.embeddings.share_memory_()
+        return self
+
+    def search(self, queries, k):
+        """squared distances and row indices of the k nearest embeddings of every query, nearest first"""
+        best_distances, best_indices = None, None
+        for start in range(0, self.embeddings.size(0), self.block_size):
+            distances = torch.cdist(queries, self.embeddings[start:start + self.block_size],
+                                    compute_mode="donot_use_mm_for_euclid_dist") ** 2
+            distances, indices = torch.topk(distances, k=min(k, distances.size(1)), dim=1, largest=False)
+            indices += start
+            if best_distances is not None:  # merge with the nearest rows of the previous blocks
+                distances = torch.cat([best_distances, distances], dim=1)
+                indices = torch.cat([best_indices, indices], dim=1)
+                distances, order = torch.topk(distances, k=min(k, distances.size(1)), dim=1, largest=False)
+                indices = torch.gather(indices, 1, order)
+            best_distances, best_indices = distances, indices
+        if best_indices is None or best_indices.size(1) < k:
+            raise ValueError("not enough node embeddings for k nearest neighbours.")
+        return best_distances, best_indices
+
+
+class IVFNeighborIndex:
+    """
+    approximate k nearest embeddings with an inverted file: embeddings are bucketed by a coarse k-means, a query
+    scans the n_probe lists with the nearest centroids, plus further lists until k candidates are seen. It only
+    pays off over ExactNeighborIndex on very large indexes (around 100k embeddings and up), on smaller ones the
+    exact blocked scan is faster for the small query batches of an mcts expansion
+    """
+
+    def __init__(self, embeddings, n_lists=None, n_probe=8, n_iter=10, seed=42):
+        self.embeddings = embeddings
+        n_lists = min(n_lists or max(1, int(math.sqrt(embeddings.size(0)))), embeddings.size(0))
+        generator = torch.Generator().manual_seed(seed)
+        init_rows = torch.randperm(embeddings.size(0), generator=generator)[:n_lists].to(embeddings.device)
+        centroids = embeddings[init_rows].clone()
+        for _ in range(n_iter):  # lloyd iterations, empty lists keep their centroid
+            assignment = torch.cdist(embeddings, centroids).argmin(dim=1)
+            counts = torch.bincount(assignment, minlength=n_lists)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, embeddings)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty].unsqueeze(1)
+        assignment = torch.cdist(embeddings, centroids).argmin(dim=1)
+        self.centroids = centroids
+        self.list_rows = torch.argsort(assignment, stable=True)  # embedding rows grouped list by list
+        self.list_ptr = torch.cat([torch.zeros(1, dtype=torch.long, device=embeddings.device),
+                                   torch.bincount(assignment, minlength=n_lists).cumsum(0)])
+        self.n_probe = min(n_probe, n_lists)
+
+    def share_memory(self):
+        for tensor in (self.embeddings, self.centroids, self.list_rows, self.list_ptr):
+            tensor.share_memory_()
+        return self
+
+    def search(self, queries, k):
+        """
+        squared distances and row indices of (approximately) the k nearest embeddings, nearest first. The probed
+        lists of all queries are gathered into one padded candidate matrix, padding is masked to inf
+        """
+        if self.embeddings.size(0) < k:
+            raise ValueError("not enough node embeddings for k nearest neighbours.")
+        device = queries.device
+        list_orders = torch.argsort(torch.cdist(queries, self.centroids), dim=1)
+        # n_probe nearest lists per query, and further ones until they hold k embeddings
+        seen = (self.list_ptr[1:] - self.list_ptr[:-1])[list_orders].cumsum(dim=1)
+        probe_nums = torch.clamp((seen < k).sum(dim=1) + 1, min=self.n_probe)
+        query_ids, probe_ranks = (torch.arange(list_orders.size(1), device=device) <
+                                  probe_nums.unsqueeze(1)).nonzero(as_tuple=True)
+        owners, positions = csr_gather(self.list_ptr, list_orders[query_ids, probe_ranks])
+        candidate_queries = query_ids[owners]
+        candidate_counts = torch.bincount(candidate_queries, minlength=queries.size(0))
+        slots = torch.arange(candidate_queries.numel(), device=device) - torch.repeat_interleave(
+            candidate_counts.cumsum(0) - candidate_counts, candidate_counts)
+        candidates = torch.zeros(queries.size(0), int(candidate_counts.max()), dtype=torch.long, device=device)
+        candidates[candidate_queries, slots] = self.list_rows[positions]
+        padding = torch.ones(candidates.shape, dtype=torch.bool, device=device)
+        padding[candidate_queries, slots] = False
+        candidate_embeddings = torch.index_select(self.embeddings, 0, candidates.flatten()).view(
+            *candidates.shape, -1)
+        distances = torch.cdist(queries.unsqueeze(1), candidate_embeddings,
+                                compute_mode="donot_use_mm_for_euclid_dist").squeeze(1) ** 2
+        distances = distances.masked_fill(padding, math.inf)
+        distances, order = torch.topk(distances, k=k, dim=1, largest=False)
+        return distances, torch.gather(candidates, 1, order)
+
+
+def build_neighbor_index(embeddings, knn_index):
+    """neighbour index over the training node embeddings for knn rewards, built once per mcts call"""
+    if knn_index == "exact":
+        return ExactNeighborIndex(embeddings)
+    elif knn_index == "ivf":
+        return IVFNeighborIndex(embeddings)
+    else:
+        raise ValueError("not supportive knn index.")